@@ -0,0 +1,148 @@
+"""Backfill the reviews history of branches
+
+    python src/backfill.py [--restart] [branch_id ...]
+
+Without branch ids, every branch users are subscribed to is backfilled.
+Progress is checkpointed per branch, an interrupted run resumes from the
+last stored page.
+"""
+import argparse
+import concurrent.futures
+import datetime
+import logging
+import threading
+
+import config
+import db
+from scraping import RateLimiter, iter_branch_review_pages
+
+reviews_db = db.get_reviews_collection()
+stats_db = db.get_branch_stats_collection()
+backfills_db = db.get_backfills_collection()
+
+# Own budget, slower than the live poller's one
+backfill_limiter = RateLimiter(config.BACKFILL_RATE)
+
+# Own threads, a backfill can take hours and must not hold the threads of
+# the bot's event loop
+executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=config.BACKFILL_WORKERS, thread_name_prefix='backfill')
+# Branch id -> future of its queued or running backfill
+_queued = {}
+_queued_lock = threading.Lock()
+# Set to stop the running backfills after their current page
+_stopping = threading.Event()
+
+
+def backfill_branch(branch_id: str, key: str = config.REVIEW_KEY) -> int:
+    """Store the whole reviews history of a branch, return the number of
+    new reviews"""
+    checkpoint = backfills_db.find_one({'branch_id': branch_id}) or {}
+    if checkpoint.get('done'):
+        return 0
+
+    if not checkpoint:
+        # Resumed even if its first page fails
+        backfills_db.update_one({'branch_id': branch_id}, {
+            '$setOnInsert': {
+                'next_link': None,
+                'done': False,
+                'updated_at': datetime.datetime.now()
+            }
+        },
+                                upsert=True)
+
+    logging.info(f'Backfilling {branch_id}')
+    stored = 0
+    pages = iter_branch_review_pages(branch_id,
+                                     key,
+                                     next_link=checkpoint.get('next_link'),
+                                     limit=config.BACKFILL_PAGE_SIZE,
+                                     limiter=backfill_limiter)
+    for reviews, next_link in pages:
+        if _stopping.is_set():
+            logging.info(f'Backfill of {branch_id} stopped')
+            break
+        stored += len(db.ingest_reviews(reviews_db, stats_db, reviews))
+        backfills_db.update_one({'branch_id': branch_id}, {
+            '$set': {
+                'next_link': next_link,
+                'done': next_link is None,
+                'updated_at': datetime.datetime.now()
+            }
+        },
+                                upsert=True)
+    logging.info(f'Backfilled {stored} reviews for {branch_id}')
+    return stored
+
+
+def _backfill_logged(branch_id: str) -> int:
+    try:
+        return backfill_branch(branch_id)
+    except Exception as e:
+        # Resumed from its checkpoint on the next run
+        logging.error(f'Backfill of {branch_id} failed: {e}')
+        return 0
+    finally:
+        with _queued_lock:
+            _queued.pop(branch_id, None)
+
+
+def enqueue_branches(
+        branch_ids: list[str]) -> list[concurrent.futures.Future]:
+    """Queue branches to the backfill workers, a branch already queued or
+    running is not queued twice"""
+    futures = []
+    with _queued_lock:
+        for branch_id in branch_ids:
+            future = _queued.get(branch_id)
+            if future is None:
+                future = executor.submit(_backfill_logged, branch_id)
+                _queued[branch_id] = future
+            futures.append(future)
+    return futures
+
+
+def backfill_branches(branch_ids: list[str]) -> int:
+    """Backfill branches in parallel, wait for them"""
+    return sum(f.result() for f in enqueue_branches(branch_ids))
+
+
+def stop():
+    """Drop the queued backfills and stop the running ones after their
+    current page, they resume from their checkpoints"""
+    _stopping.set()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_unfinished_branch_ids() -> list[str]:
+    return backfills_db.distinct('branch_id', {'done': False})
+
+
+def get_subscribed_branch_ids() -> list[str]:
+    users_db = db.get_users_collection()
+    return [
+        dico['branch_id'] for dico in db.get_branches_with_users(users_db)
+    ]
+
+
+def main():
+    format = "%(levelname)s:%(asctime)s:%(message)s"
+    logging.basicConfig(format=format, level=logging.INFO, datefmt="%H:%M:%S")
+
+    parser = argparse.ArgumentParser(description='Backfill reviews history')
+    parser.add_argument('branch_ids', nargs='*')
+    parser.add_argument('--restart',
+                        action='store_true',
+                        help='ignore checkpoints and start over')
+    args = parser.parse_args()
+
+    branch_ids = args.branch_ids or get_subscribed_branch_ids()
+    if args.restart:
+        backfills_db.delete_many({'branch_id': {'$in': branch_ids}})
+    stored = backfill_branches(branch_ids)
+    logging.info(f'Backfilled {stored} reviews for {len(branch_ids)} branches')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""Record 2gis pages and benchmark the parsers on them offline
+
+    python src/bench.py record --company "Вкусно — и точка" [--city ufa]
+                               [--pages 2] [--branches 3] [--browser]
+    python src/bench.py run [--repeat 20]
+
+Recorded search pages, reviews pages (--browser) and reviews api answers
+are stored under fixtures/. A parser finding nothing in its fixtures fails
+the run, which is how 2gis class names changes show up.
+"""
+import argparse
+import asyncio
+import logging
+import re
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import lxml.html
+import requests
+
+import config
+import scraping
+from models import reviews_page_decoder
+from utils import clean_text
+
+FIXTURES_DIR = Path(__file__).resolve().parent.parent / 'fixtures'
+
+####
+## Record
+####
+
+
+def _save(kind: str, name: str, content: bytes) -> Path:
+    path = FIXTURES_DIR / kind / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    logging.info(f'Recorded {path}')
+    return path
+
+
+def record_search_pages(company_name: str, city: str,
+                        pages: int) -> list[dict]:
+    """Record the first search pages, return the branches found"""
+    slug = re.sub(r'\W+', '-', company_name.lower()).strip('-')
+    url = f"https://2gis.ru/{city}/search/{company_name}"
+    session = requests.Session()
+    session.headers['User-Agent'] = scraping.USER_AGENT
+    branches = []
+    for counter in range(1, pages + 1):
+        res = session.get(url if counter == 1 else f"{url}/page/{counter}")
+        if res.status_code != 200:
+            break
+        _save('search', f'{city}-{slug}-{counter}.html', res.content)
+        branches.extend(
+            scraping.parse_branches_page(lxml.html.fromstring(res.content),
+                                         city))
+    return branches
+
+
+def record_api_reviews(branch_id: str):
+    res = requests.get(f"{config.REVIEW_API_URL}/{branch_id}/reviews",
+                       params={
+                           'key': config.REVIEW_KEY,
+                           'limit': 50,
+                           'sort_by': 'date_created'
+                       })
+    if res.status_code == 200:
+        _save('api', f'{branch_id}.json', res.content)
+
+
+async def record_reviews_pages(branches: list[dict]):
+    import browser
+
+    chrome = await browser.launch(headless=True)
+    try:
+        for branch in branches:
+            html = await browser.record_reviews_page(chrome, branch['link'])
+            _save('reviews_page', f"{branch['id']}.html", html.encode())
+    finally:
+        await chrome.close()
+
+
+def record(args):
+    branches = record_search_pages(args.company, args.city, args.pages)
+    branches = branches[:args.branches]
+    for branch in branches:
+        record_api_reviews(branch['id'])
+    if args.browser:
+        asyncio.run(record_reviews_pages(branches))
+
+####
+## Replay
+####
+
+
+def _whole(content: bytes) -> list[str]:
+    return [content.decode()]
+
+
+def _divs(selector: str):
+
+    def split(content: bytes) -> list[str]:
+        return [
+            lxml.html.tostring(div, encoding='unicode')
+            for div in lxml.html.fromstring(content).cssselect(selector)
+        ]
+
+    return split
+
+
+def _parse_review_html(html: str) -> list[dict]:
+    import browser
+    return [browser.parse_review_html(html)]
+
+
+# name, fixtures kind, split a fixture into inputs, parse an input into items
+PARSERS = [
+    ('get_branches', 'search', _whole,
+     lambda html: scraping.parse_branches_page(lxml.html.fromstring(html))),
+    ('extract_branches_data_from_divs', 'search', _divs('div._1kf6gff'),
+     lambda html: [
+         scraping.parse_branch_div(lxml.html.fromstring(clean_text(html)),
+                                   'bench')
+     ]),
+    ('get_review_data', 'reviews_page', _divs('div._11gvyqv'),
+     _parse_review_html),
+    ('clean_api_reviews', 'api', lambda content: [content],
+     lambda content: scraping.clean_api_reviews(
+         reviews_page_decoder.decode(content).reviews, 'bench')),
+    ('clean_text', 'reviews_page', _divs('div._11gvyqv'),
+     lambda html: [clean_text(html)]),
+]
+
+
+def bench(name: str, kind: str, split, parse, repeat: int) -> bool:
+    """Print the parser throughput and memory, False if it found nothing"""
+    paths = sorted((FIXTURES_DIR / kind).glob('*'))
+    if not paths:
+        print(f'{name:<32} FAILED, no {kind} fixtures, record some first')
+        return False
+    inputs = [item for path in paths for item in split(path.read_bytes())]
+    items = sum(len(parse(item)) for item in inputs)
+    if not items:
+        print(f'{name:<32} FAILED, nothing parsed from {len(paths)} fixtures')
+        return False
+
+    started_at = time.perf_counter()
+    for _ in range(repeat):
+        for item in inputs:
+            parse(item)
+    elapsed = time.perf_counter() - started_at
+
+    tracemalloc.start()
+    results = [parse(item) for item in inputs]
+    blocks = sum(stat.count
+                 for stat in tracemalloc.take_snapshot().statistics('filename'))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del results
+
+    print(f'{name:<32} {items:>6} items {items * repeat / elapsed:>10.0f} '
+          f'items/s {peak / items / 1024:>8.1f} KiB/item peak '
+          f'{blocks / items:>8.1f} blocks/item')
+    return True
+
+
+def run(args):
+    ok = True
+    for name, kind, split, parse in PARSERS:
+        ok = bench(name, kind, split, parse, args.repeat) and ok
+    return ok
+
+
+def main():
+    format = "%(levelname)s:%(asctime)s:%(message)s"
+    logging.basicConfig(format=format, level=logging.INFO, datefmt="%H:%M:%S")
+
+    parser = argparse.ArgumentParser(description='Parsers fixtures and '
+                                     'benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    record_parser = subparsers.add_parser('record')
+    record_parser.add_argument('--company', required=True)
+    record_parser.add_argument('--city', default='ufa')
+    record_parser.add_argument('--pages', type=int, default=2)
+    record_parser.add_argument('--branches', type=int, default=3)
+    record_parser.add_argument('--browser',
+                               action='store_true',
+                               help='also record reviews pages, needs chrome')
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args)
+    elif not run(args):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
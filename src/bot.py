@@ -1,8 +1,16 @@
+import asyncio
 import datetime
+import html
 import logging
+import shlex
+import tempfile
+import time
+from pathlib import Path
 
 import emoji
+from bson import ObjectId
 from dateutil.parser import isoparse
+from pymongo import ReturnDocument
 from pymongo.errors import BulkWriteError
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, ReplyKeyboardMarkup
 from telegram.constants import ParseMode
@@ -10,14 +18,34 @@ from telegram.ext import (Application, CallbackQueryHandler, CommandHandler,
                           ConversationHandler, ContextTypes, MessageHandler,
                           filters)
 
+import backfill
+import catalog
+import cache
 import db
-from config import REVIEW_KEY, TG_LINK, SENDING_INTERVAL
-from scraping import get_branch_reviews, get_branches
-from utils import get_cached_datetime, send_reviews, set_cached_datetime, build_branches_markup
+import export
+import profiling
+import retention
+from config import (ADMIN_IDS, CATALOG_REFRESH_INTERVAL, CITIES,
+                    OUTBOX_INTERVAL, RETENTION_INTERVAL, REVIEW_KEY, REVIEWS_CACHE_TTL, TG_LINK,
+                    SENDING_INTERVAL, SLOW_CYCLE_THRESHOLD,
+                    SLOW_HANDLER_THRESHOLD)
+from models import Review
+from scraping import get_branch_reviews, merge_branches, stream_branches
+from utils import (UPLOAD_LIMIT, build_branches_markup, build_digest_messages,
+                   deliver_reviews, format_branch_stats, get_cached_datetime,
+                   send_digest, send_reviews, set_cached_datetime)
 
 users_db = db.get_users_collection()
 companies_db = db.get_companies_collection()
 branches_db = db.get_branches_collection()
+searches_db = db.get_searches_collection()
+reviews_db = db.get_reviews_collection()
+stats_db = db.get_branch_stats_collection()
+outbox_db = db.get_outbox_collection()
+outbox_leases_db = db.get_outbox_leases_collection()
+
+# Branch id -> latest reviews, refreshed by the poller
+latest_reviews_cache = cache.TTLCache(REVIEWS_CACHE_TTL)
 
 ADD, REMOVE, SHOW = ['✅Добавить', '❌Удалить', 'Показать']
 main_menu_markup = ReplyKeyboardMarkup([[ADD, REMOVE], [SHOW]],
@@ -26,6 +54,17 @@ main_menu_markup = ReplyKeyboardMarkup([[ADD, REMOVE], [SHOW]],
 (COMPANY_INPUT, COMPANY_CONFIRMATION, ADD_BRANCH_CHOICE, REMOVE_BRANCH_CHOICE,
  SHOW_BRANCH_CHOICE) = range(1, 6)
 
+# Callback data stays short: search confirmations carry the stored search id,
+# branch buttons carry the bare branch id
+SEARCH_PREFIX = 'search:'
+SEARCH_NO = f'{SEARCH_PREFIX}no'
+BRANCH_PATTERN = '^[^:]+$'
+STATS_PREFIX = 'stats:'
+# Scope of a /search, a branch id, a company id or all the user's companies
+FIND_PREFIX = 'find:'
+FIND_COMPANY_PREFIX = f'{FIND_PREFIX}company:'
+FIND_ALL = f'{FIND_PREFIX}all'
+
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_chat.id
@@ -75,7 +114,7 @@ async def reply_keyboard_callback(update: Update,
                 parse_mode=ParseMode.HTML)
             # await show_menu(update, context)
             return
-        branches = user['branches']
+        branches = db.get_user_branches(branches_db, user)
         branches_markup = build_branches_markup(branches,
                                                 with_company_name=True)
         await context.bot.send_message(
@@ -95,7 +134,7 @@ async def reply_keyboard_callback(update: Update,
                 parse_mode=ParseMode.HTML)
             # await show_menu(update, context)
             return
-        branches = user['branches']
+        branches = db.get_user_branches(branches_db, user)
         branches_markup = build_branches_markup(branches,
                                                 with_company_name=True)
         await context.bot.send_message(
@@ -108,6 +147,7 @@ async def reply_keyboard_callback(update: Update,
         return SHOW_BRANCH_CHOICE
 
 
+@profiling.profiled('company_input', SLOW_HANDLER_THRESHOLD)
 async def company_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Manage company subscription"""
 
@@ -120,7 +160,22 @@ async def company_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                              text="⏳⌛ <i>Ищу компанию...</i>",
                                              parse_mode=ParseMode.HTML)
 
-    data = get_branches(company_name=input_text)
+    # Cities are searched at once, the progress is shown as they complete
+    data = []
+    searched = 0
+    edited_at = time.monotonic()
+    async for city, branches in stream_branches(input_text, CITIES):
+        searched += 1
+        data.extend(branches)
+        if searched < len(CITIES) and time.monotonic() - edited_at > 1:
+            edited_at = time.monotonic()
+            await context.bot.edit_message_text(
+                chat_id=update.effective_chat.id,
+                message_id=message.message_id,
+                text=f"⏳⌛ <i>Ищу компанию... {searched}/{len(CITIES)}, "
+                f"найдено филиалов: {len(data)}</i>",
+                parse_mode=ParseMode.HTML)
+    data = merge_branches(data)
     if not data:
         logging.info('no branches found')
         await context.bot.edit_message_text(
@@ -133,10 +188,16 @@ async def company_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     logging.info('branches found')
     company_name = data[0]['org_name']
+    search = searches_db.insert_one({
+        'query': input_text,
+        'branches': data,
+        'created_at': datetime.datetime.now(datetime.timezone.utc)
+    })
     confirmation_markup = InlineKeyboardMarkup([
         [
-            InlineKeyboardButton(text='Да', callback_data=data),
-            InlineKeyboardButton(text='Нет', callback_data=['No'])
+            InlineKeyboardButton(
+                text='Да', callback_data=f'{SEARCH_PREFIX}{search.inserted_id}'),
+            InlineKeyboardButton(text='Нет', callback_data=SEARCH_NO)
         ],
     ])
     await context.bot.edit_message_text(
@@ -153,27 +214,48 @@ async def confirm_company(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Confirm company choice"""
     query = update.callback_query
     await query.answer()
-    callback_data = query.data
-    if callback_data[0] == 'No':
+    if query.data == SEARCH_NO:
         await query.edit_message_text(
             text=emoji.emojize(":pencil: <b>Введите название компании</b>"),
             parse_mode=ParseMode.HTML)
         return COMPANY_INPUT
 
-    lookup = {'name': callback_data[0]['org_name']}
-    result = companies_db.replace_one(lookup, lookup, upsert=True)
-    company = companies_db.find_one({'_id': result.upserted_id})
-    for branch in callback_data:
+    search_id = query.data.removeprefix(SEARCH_PREFIX)
+    search = None
+    if ObjectId.is_valid(search_id):
+        search = searches_db.find_one({'_id': ObjectId(search_id)})
+    if search is None:
+        # The search expired, ask for the company again
+        await query.edit_message_text(text=emoji.emojize(
+            ":hourglass_done: <i>Результаты поиска устарели</i>\n\n"
+            ":pencil: <b>Введите название компании</b>"),
+                                      parse_mode=ParseMode.HTML)
+        return COMPANY_INPUT
+
+    lookup = {'name': search['branches'][0]['org_name']}
+    # The query is searched again to refresh the company branches
+    company = companies_db.find_one_and_update(
+        lookup, {
+            '$setOnInsert': lookup,
+            '$set': {
+                'query': search['query']
+            }
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER)
+    branches = []
+    for branch in search['branches']:
         branch.pop('org_name')
-        branch['company'] = company
+        branch['company'] = db.company_reference(company)
+        branches.append(branch)
 
-    branches_markup = build_branches_markup(callback_data)
+    branches_markup = build_branches_markup(branches)
     await query.edit_message_text(
         text=emoji.emojize(f"<i>Выберите филиал компании</i>:"),
         reply_markup=branches_markup,
         parse_mode=ParseMode.HTML)
     try:
-        branches_db.insert_many(callback_data, ordered=False)
+        branches_db.insert_many(branches, ordered=False)
     except BulkWriteError as bwe:
         # Duplicate key error
         pass
@@ -188,11 +270,18 @@ async def add_branch_choice(update: Update,
     branch_id = query.data
     user = users_db.find_one({'id': query.from_user.id})
     branch = branches_db.find_one({'id': branch_id})
-    if branch not in user['branches']:
+    if branch_id not in [b['id'] for b in user['branches']]:
+        # Only the id is kept, the branch is looked up when needed
         users_db.update_one({'id': query.from_user.id},
                             {'$push': {
-                                'branches': branch
+                                'branches': {
+                                    'id': branch_id
+                                }
                             }})
+        context.job_queue.run_once(backfill_job,
+                                   when=0,
+                                   data=[branch_id],
+                                   name=f'backfill {branch_id}')
 
         await query.edit_message_text(text=emoji.emojize(
             f"✅<i>Добавлено</i>: <b>{branch['company']['name']}, {branch['name']}</b>"
@@ -212,13 +301,13 @@ async def remove_branch_choice(update: Update,
     query = update.callback_query
     await query.answer()
     branch_id = query.data
-    user = users_db.find_one({'id': query.from_user.id})
     branch = branches_db.find_one({'id': branch_id})
-    if branch in user['branches']:
-        users_db.update_one({'id': query.from_user.id},
-                            {'$pull': {
-                                'branches': branch
-                            }})
+    users_db.update_one({'id': query.from_user.id},
+                        {'$pull': {
+                            'branches': {
+                                'id': branch_id
+                            }
+                        }})
 
     await query.edit_message_text(text=emoji.emojize(
         f"❌<i>Удалено</i>: <b>{branch['company']['name']}, {branch['name']}</b>"
@@ -234,7 +323,17 @@ async def show_branch_reviews(update: Update,
     await query.answer()
     branch_id = query.data
 
-    reviews = get_branch_reviews(branch_id, REVIEW_KEY, limit=5)
+    try:
+        reviews = await latest_reviews_cache.get(
+            branch_id, lambda: asyncio.to_thread(
+                get_branch_reviews, branch_id, REVIEW_KEY, limit=5))
+    except Exception as e:
+        logging.error(e)
+        await query.edit_message_text(text=emoji.emojize(
+            ":confused_face:<i>Не удалось получить отзывы, "
+            "попробуйте позже</i>"),
+                                      parse_mode=ParseMode.HTML)
+        return ConversationHandler.END
     if not reviews:
         await query.edit_message_text(
             text=emoji.emojize(f":confused_face:<i>Нет отзывов</i>"),
@@ -252,37 +351,405 @@ async def show_branch_reviews(update: Update,
     return ConversationHandler.END
 
 
+@profiling.profiled('send_repeating', SLOW_CYCLE_THRESHOLD)
 async def send_repeating(context: ContextTypes.DEFAULT_TYPE):
+    """Queue the new reviews of every subscribed branch, then send them"""
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    # Start of the previous cycle, the watermark of branches polled for the
+    # first time
+    last_sent_at = get_cached_datetime()
+    logging.info(f"Last sent at {last_sent_at.isoformat()}")
     try:
-        last_sent_at = get_cached_datetime()
-        logging.info(f"Last sent at {last_sent_at.isoformat()}")
         branches_with_users_ids = db.get_branches_with_users(users_db)
-        logging.info("Sending repeating message")
-        sent = False
-        for dico in branches_with_users_ids:
-            user_ids, branch_name, company_name = dico['user_ids'], dico[
-                'branch_name'], dico['company']
-            reviews = get_branch_reviews(dico['branch_id'],
-                                         REVIEW_KEY,
-                                         limit=5)
+    except Exception as e:
+        logging.error(e)
+        return
+    logging.info("Queueing repeating message")
+    for dico in branches_with_users_ids:
+        user_ids, branch_name, company_name = dico['user_ids'], dico[
+            'branch_name'], dico['company']
+        # Each branch keeps its own watermark, a branch failing for a while
+        # does not hold the others back
+        sent_until = dico.get('sent_until')
+        if sent_until is None:
+            sent_until = last_sent_at
+        else:
+            sent_until = sent_until.replace(tzinfo=datetime.timezone.utc)
+        try:
+            reviews = await asyncio.to_thread(get_branch_reviews,
+                                              dico['branch_id'],
+                                              REVIEW_KEY,
+                                              limit=5)
+            db.ingest_reviews(reviews_db, stats_db, reviews)
+            latest_reviews_cache.put(dico['branch_id'], reviews)
             reviews_to_send = [
                 review for review in reviews
-                if isoparse(review['date']).astimezone() > last_sent_at
+                if isoparse(review.date).astimezone() > sent_until
             ]
-            if not reviews_to_send:
+            if reviews_to_send:
+                logging.info(f"Queueing {len(reviews_to_send)} reviews")
+                db.enqueue_deliveries(outbox_db, user_ids, reviews_to_send,
+                                      branch_name, company_name)
+            else:
                 logging.info(f"No reviews to send for {branch_name}")
-                continue
-            logging.info(f"Sending {len(reviews_to_send)} reviews")
-            await send_reviews(context, user_ids, reviews_to_send, branch_name,
-                               company_name)
-            if not sent:
-                sent = True
+            branches_db.update_one({'id': dico['branch_id']},
+                                   {'$set': {
+                                       'sent_until': started_at
+                                   }})
+        except Exception as e:
+            # Polled again from its watermark, deliveries queued again are
+            # not sent twice
+            logging.error(f"Polling {branch_name} failed: {e}")
+            if dico.get('sent_until') is None:
+                branches_db.update_one(
+                    {
+                        'id': dico['branch_id'],
+                        'sent_until': None
+                    }, {'$set': {
+                        'sent_until': sent_until
+                    }})
+    set_cached_datetime(started_at)
+    await deliver_outbox(context)
+
+
+async def deliver_outbox(context: ContextTypes.DEFAULT_TYPE):
+    """Send the queued deliveries, one user at a time"""
+    digest_user_ids = set(users_db.distinct('id', {'digest': True}))
+    # Users that failed in this run or are leased by another replica
+    skipped_user_ids = []
+    while True:
+        claim, deliveries = db.claim_deliveries(outbox_db, outbox_leases_db,
+                                                skipped_user_ids)
+        if not deliveries:
+            break
+        user_id = deliveries[0]['user_id']
+        # (branch_name, company_name) -> reviews, in the queue order
+        sections = {}
+        for delivery in deliveries:
+            sections.setdefault(
+                (delivery['branch_name'], delivery['company_name']),
+                []).append(Review.from_document(delivery['review']))
+
+        # Delivery ids in the order they are sent
+        order = [
+            db.delivery_id(review.id, user_id)
+            for reviews in sections.values() for review in reviews
+        ]
+        acked = set()
+
+        def ack(reviews: list[Review]):
+            ids = [db.delivery_id(review.id, user_id) for review in reviews]
+            db.ack_deliveries(outbox_db, ids)
+            acked.update(ids)
+            if not db.renew_claim(outbox_leases_db, user_id, claim):
+                raise db.LeaseLostError(user_id)
+
+        try:
+            if user_id in digest_user_ids:
+                logging.info(f"Sending digest of {len(sections)} branches")
+                await send_digest(context, user_id, [
+                    (branch_name, company_name, reviews)
+                    for (branch_name, company_name), reviews in sections.items()
+                ], ack)
+            else:
+                for (branch_name,
+                     company_name), reviews in sections.items():
+                    await deliver_reviews(context, user_id, reviews,
+                                          branch_name, company_name,
+                                          lambda review: ack([review]))
+        except db.LeaseLostError:
+            # The other replica sends the rest
+            logging.warning(f"Lease of {user_id} was taken over")
+        except Exception as e:
+            # Only the delivery being sent counts the failure, the others
+            # are retried as they were by the next run
+            skipped_user_ids.append(user_id)
+            logging.error(f"Delivery to {user_id} failed: {e}")
+            failed_ids = [
+                delivery_id for delivery_id in order
+                if delivery_id not in acked
+            ][:1]
+            db.release_claim(outbox_db, outbox_leases_db, user_id, claim,
+                             failed_ids)
+        else:
+            db.release_claim(outbox_db, outbox_leases_db, user_id, claim)
+
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Choose a branch to show the ratings statistics of"""
+    user_id = update.effective_chat.id
+    user = users_db.find_one({'id': user_id})
+    if not user['branches']:
+        await context.bot.send_message(
+            chat_id=user_id,
+            text=emoji.emojize(
+                ":confused_face: <i>Вы еще не добавили ни одной компании</i>"),
+            parse_mode=ParseMode.HTML)
+        return
+    branches_markup = build_branches_markup(db.get_user_branches(
+        branches_db, user),
+                                            with_company_name=True,
+                                            callback_prefix=STATS_PREFIX)
+    await context.bot.send_message(
+        chat_id=user_id,
+        text=emoji.emojize(
+            ":bar_chart: <i>Выберите компанию, статистику которой хотите посмотреть</i>"
+        ),
+        reply_markup=branches_markup,
+        parse_mode=ParseMode.HTML)
+
+
+async def show_branch_stats(update: Update,
+                            context: ContextTypes.DEFAULT_TYPE):
+    """Show the precomputed ratings statistics of a branch"""
+    query = update.callback_query
+    await query.answer()
+    branch_id = query.data.removeprefix(STATS_PREFIX)
+    branch_stats = stats_db.find_one({'branch_id': branch_id})
+    if branch_stats is None:
+        await query.edit_message_text(
+            text=emoji.emojize(f":confused_face:<i>Нет отзывов</i>"),
+            parse_mode=ParseMode.HTML)
+        return
+    branch = branches_db.find_one({'id': branch_id})
+    await query.edit_message_text(text=format_branch_stats(
+        branch_stats, branch['name'], branch['company']['name']),
+                                  parse_mode=ParseMode.HTML)
+
+
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Choose where to search the stored reviews"""
+    user_id = update.effective_chat.id
+    text = ' '.join(context.args)
+    if not text:
+        await context.bot.send_message(
+            chat_id=user_id,
+            text="<i>Использование</i>: /search <b>слова</b>",
+            parse_mode=ParseMode.HTML)
+        return
+    user = users_db.find_one({'id': user_id})
+    user_branches = db.get_user_branches(branches_db, user)
+    if not user_branches:
+        await context.bot.send_message(
+            chat_id=user_id,
+            text=emoji.emojize(
+                ":confused_face: <i>Вы еще не добавили ни одной компании</i>"),
+            parse_mode=ParseMode.HTML)
+        return
+    context.user_data['search_text'] = text
+
+    companies = {
+        str(branch['company']['_id']): branch['company']['name']
+        for branch in user_branches if '_id' in branch['company']
+    }
+    buttons = [[
+        InlineKeyboardButton(text='Все компании',
+                             callback_data=FIND_ALL)
+    ]] + [[
+        InlineKeyboardButton(text=f"{name.split(',')[0]} - все филиалы",
+                             callback_data=f'{FIND_COMPANY_PREFIX}{company_id}')
+    ] for company_id, name in companies.items()]
+    branches_markup = build_branches_markup(user_branches,
+                                            with_company_name=True,
+                                            callback_prefix=FIND_PREFIX)
+    await context.bot.send_message(
+        chat_id=user_id,
+        text=emoji.emojize(":magnifying_glass_tilted_left: <i>Где искать?</i>"),
+        reply_markup=InlineKeyboardMarkup(buttons +
+                                          list(branches_markup.inline_keyboard)),
+        parse_mode=ParseMode.HTML)
+
+
+async def search_scope(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Search the stored reviews of a branch, a company or all the user's
+    companies"""
+    query = update.callback_query
+    await query.answer()
+    user_id = update.effective_chat.id
+    text = context.user_data.get('search_text')
+    if not text:
+        await query.edit_message_text(
+            text="<i>Использование</i>: /search <b>слова</b>",
+            parse_mode=ParseMode.HTML)
+        return
+
+    if query.data == FIND_ALL:
+        user = users_db.find_one({'id': user_id})
+        branches_query = {
+            'company.name': {
+                '$in':
+                list({
+                    branch['company']['name']
+                    for branch in db.get_user_branches(branches_db, user)
+                })
+            }
+        }
+    elif query.data.startswith(FIND_COMPANY_PREFIX):
+        company_id = query.data.removeprefix(FIND_COMPANY_PREFIX)
+        if not ObjectId.is_valid(company_id):
+            return
+        branches_query = {'company._id': ObjectId(company_id)}
+    else:
+        branches_query = {'id': query.data.removeprefix(FIND_PREFIX)}
+    branches = {
+        branch['id']: branch
+        for branch in branches_db.find(branches_query, {
+            'id': 1,
+            'name': 1,
+            'company.name': 1
+        })
+    }
+    await query.edit_message_text(
+        text=emoji.emojize(
+            f":magnifying_glass_tilted_left: <i>Ищу «{html.escape(text)}»</i>"),
+        parse_mode=ParseMode.HTML)
+    reviews = db.search_reviews(reviews_db, text, list(branches))
+    if not reviews:
+        await context.bot.send_message(
+            chat_id=user_id,
+            text=emoji.emojize(":confused_face: <i>Ничего не нашел</i>"),
+            parse_mode=ParseMode.HTML)
+        return
+
+    # Group the results by branch, keeping the relevance order
+    sections = {}
+    for review in reviews:
+        sections.setdefault(review.branch_id, []).append(review)
+    for message in build_digest_messages([
+        (branches[branch_id]['name'], branches[branch_id]['company']['name'],
+         branch_reviews) for branch_id, branch_reviews in sections.items()
+    ]):
+        await context.bot.send_message(chat_id=user_id,
+                                       text=message,
+                                       parse_mode=ParseMode.HTML)
+
+
+async def backfill_job(context: ContextTypes.DEFAULT_TYPE):
+    """Queue the backfill of the job's branches, or of the unfinished
+    backfills when none are given"""
+    branch_ids = context.job.data
+    if branch_ids is None:
+        branch_ids = backfill.get_unfinished_branch_ids()
+    if not branch_ids:
+        return
+    # Run by the backfill workers, not by the event loop's threads
+    backfill.enqueue_branches(branch_ids)
+    logging.info(f"Queued {len(branch_ids)} backfills")
+
+
+async def start_backfill(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command, backfill every subscribed branch"""
+    branch_ids = backfill.get_subscribed_branch_ids()
+    context.job_queue.run_once(backfill_job,
+                               when=0,
+                               data=branch_ids,
+                               name='backfill')
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=f"<i>Загрузка истории отзывов: {len(branch_ids)} филиалов</i>",
+        parse_mode=ParseMode.HTML)
+
+
+async def refresh_catalogs_job(context: ContextTypes.DEFAULT_TYPE):
+    """Apply the branches openings, changes and closures of companies"""
+    try:
+        changes = await asyncio.to_thread(catalog.refresh_catalogs)
+        logging.info(f"Catalogs refreshed, {changes} changes")
+    except Exception as e:
+        logging.error(e)
+
+
+async def export_reviews(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command, send the stored reviews as a file"""
+    usage = (f"<i>Использование</i>: /export [{'|'.join(export.FORMATS)}] "
+             "[с YYYY-MM-DD] [до YYYY-MM-DD] "
+             "[--company \"название\" ...] [--branch id ...]")
+    try:
+        companies, branch_ids, args = [], [], []
+        since = until = None
+        tokens = iter(shlex.split(' '.join(context.args)))
+        for arg in tokens:
+            if arg in ('--company', '--branch', 'с', 'до'):
+                value = next(tokens, None)
+                if value is None:
+                    raise ValueError(f'{arg} needs a value')
+                if arg == '--company':
+                    companies.append(value)
+                elif arg == '--branch':
+                    branch_ids.append(value)
+                elif arg == 'с':
+                    since = datetime.datetime.fromisoformat(value)
+                else:
+                    until = datetime.datetime.fromisoformat(value)
+            else:
+                args.append(arg)
+        format = args.pop(0) if args and args[0] in export.FORMATS else 'jsonl'
+        if args:
+            raise ValueError(f'Unexpected arguments {args}')
+    except ValueError:
+        await context.bot.send_message(chat_id=update.effective_chat.id,
+                                       text=usage,
+                                       parse_mode=ParseMode.HTML)
+        return
+
+    suffix = '.parquet' if format == 'parquet' else f'.{format}.gz'
+    with tempfile.TemporaryDirectory() as directory:
+        output = Path(directory) / f'reviews{suffix}'
+        try:
+            exported = await asyncio.to_thread(export.export_reviews,
+                                               output,
+                                               format,
+                                               companies=companies or None,
+                                               branch_ids=branch_ids or None,
+                                               since=since,
+                                               until=until)
+            size = output.stat().st_size
+            if size > UPLOAD_LIMIT:
+                await context.bot.send_message(
+                    chat_id=update.effective_chat.id,
+                    text=f"<i>Файл слишком большой</i>: "
+                    f"{size / 1024 / 1024:.1f} МБ из "
+                    f"{UPLOAD_LIMIT // 1024 // 1024} МБ, выберите меньше "
+                    f"компаний или дат",
+                    parse_mode=ParseMode.HTML)
+                return
+            await context.bot.send_document(chat_id=update.effective_chat.id,
+                                            document=output,
+                                            caption=f"Отзывов: {exported}")
+        except Exception as e:
+            logging.error(e)
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text=f"<i>Ошибка</i>: {html.escape(str(e))}",
+                parse_mode=ParseMode.HTML)
+
+
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command, sample the next runs of a job or handler"""
+    names = ('send_repeating', 'company_input')
+    runs = context.args[1] if context.args[1:] else '1'
+    if (not context.args or context.args[0] not in names
+            or not runs.isdigit() or not int(runs)):
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=f"<i>Использование</i>: /profile {'|'.join(names)} [runs]",
+            parse_mode=ParseMode.HTML)
+        return
+    name = context.args[0]
+    runs = int(runs)
+    profiling.arm(name, runs)
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=f"<i>Профилирование</i>: {name} x{runs}",
+        parse_mode=ParseMode.HTML)
+
+
+async def retention_job(context: ContextTypes.DEFAULT_TYPE):
+    """Archive old reviews and compact the stored documents"""
+    try:
+        await asyncio.to_thread(retention.apply_retention)
     except Exception as e:
         logging.error(e)
-    else:
-        if sent:
-            logging.info("Sending repeating message done")
-            set_cached_datetime(datetime.datetime.now())
 
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -293,6 +760,21 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+async def toggle_digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Switch between one message per review and a single digest"""
+    user_id = update.effective_chat.id
+    user = users_db.find_one({'id': user_id})
+    digest = not user.get('digest', False)
+    users_db.update_one({'id': user_id}, {'$set': {'digest': digest}})
+    if digest:
+        text = ":newspaper: <i>Новые отзывы будут приходить одной сводкой</i>"
+    else:
+        text = ":envelope: <i>Каждый новый отзыв будет приходить отдельно</i>"
+    await context.bot.send_message(chat_id=user_id,
+                                   text=emoji.emojize(text),
+                                   parse_mode=ParseMode.HTML)
+
+
 async def feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send feedback"""
     button = InlineKeyboardButton(text="📧 Написать", url=TG_LINK)
@@ -303,6 +785,11 @@ async def feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                    parse_mode=ParseMode.HTML)
 
 
+async def teardown(app: Application):
+    """Stop the backfills, they resume from their checkpoints"""
+    backfill.stop()
+
+
 def setup(app: Application):
     """Set the bot handlers and job queue"""
 
@@ -319,10 +806,14 @@ def setup(app: Application):
                                (~filters.Text([ADD, REMOVE, SHOW])),
                                callback=company_input)
             ],
-            COMPANY_CONFIRMATION:
-            [CallbackQueryHandler(callback=confirm_company, pattern=list)],
-            ADD_BRANCH_CHOICE:
-            [CallbackQueryHandler(callback=add_branch_choice, pattern=str)]
+            COMPANY_CONFIRMATION: [
+                CallbackQueryHandler(callback=confirm_company,
+                                     pattern=f'^{SEARCH_PREFIX}')
+            ],
+            ADD_BRANCH_CHOICE: [
+                CallbackQueryHandler(callback=add_branch_choice,
+                                     pattern=BRANCH_PATTERN)
+            ]
         },
         fallbacks=[
             CommandHandler(command='cancel', callback=cancel),
@@ -340,8 +831,10 @@ def setup(app: Application):
                            callback=reply_keyboard_callback),
         ],
         states={
-            REMOVE_BRANCH_CHOICE:
-            [CallbackQueryHandler(callback=remove_branch_choice, pattern=str)]
+            REMOVE_BRANCH_CHOICE: [
+                CallbackQueryHandler(callback=remove_branch_choice,
+                                     pattern=BRANCH_PATTERN)
+            ]
         },
         fallbacks=[
             CommandHandler(command='cancel', callback=cancel),
@@ -359,8 +852,10 @@ def setup(app: Application):
                            callback=reply_keyboard_callback),
         ],
         states={
-            SHOW_BRANCH_CHOICE:
-            [CallbackQueryHandler(callback=show_branch_reviews, pattern=str)]
+            SHOW_BRANCH_CHOICE: [
+                CallbackQueryHandler(callback=show_branch_reviews,
+                                     pattern=BRANCH_PATTERN)
+            ]
         },
         fallbacks=[
             CommandHandler(command='cancel', callback=cancel),
@@ -376,6 +871,37 @@ def setup(app: Application):
     app.add_handler(remove_handler)
     app.add_handler(show_handler)
     app.add_handler(CommandHandler(command='feedback', callback=feedback))
+    app.add_handler(CommandHandler(command='digest', callback=toggle_digest))
+    app.add_handler(CommandHandler(command='stats', callback=stats))
+    app.add_handler(
+        CallbackQueryHandler(callback=show_branch_stats,
+                             pattern=f'^{STATS_PREFIX}'))
+    app.add_handler(CommandHandler(command='search', callback=search))
+    app.add_handler(
+        CallbackQueryHandler(callback=search_scope,
+                             pattern=f'^{FIND_PREFIX}'))
+    app.add_handler(
+        CommandHandler(command='backfill',
+                       callback=start_backfill,
+                       filters=filters.User(user_id=ADMIN_IDS)))
+    app.add_handler(
+        CommandHandler(command='export',
+                       callback=export_reviews,
+                       filters=filters.User(user_id=ADMIN_IDS)))
+    app.add_handler(
+        CommandHandler(command='profile',
+                       callback=profile,
+                       filters=filters.User(user_id=ADMIN_IDS)))
 
     job_queue = app.job_queue
     job_queue.run_repeating(send_repeating, interval=SENDING_INTERVAL, first=0)
+    # Leftovers of crashed or failed runs, from this replica or another one
+    job_queue.run_repeating(deliver_outbox,
+                            interval=OUTBOX_INTERVAL,
+                            first=OUTBOX_INTERVAL)
+    job_queue.run_repeating(refresh_catalogs_job,
+                            interval=CATALOG_REFRESH_INTERVAL,
+                            first=CATALOG_REFRESH_INTERVAL)
+    job_queue.run_repeating(retention_job, interval=RETENTION_INTERVAL, first=0)
+    # Resume the backfills interrupted by a restart
+    job_queue.run_once(backfill_job, when=0, name='backfill')
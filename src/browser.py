@@ -0,0 +1,351 @@
+"""Browser based scraping, imported lazily as it pulls pyppeteer in"""
+import asyncio
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+import lxml.html
+from fake_useragent import UserAgent
+from pyppeteer.browser import Browser
+from pyppeteer.element_handle import ElementHandle
+from pyppeteer.errors import ElementHandleError
+from pyppeteer.launcher import launch
+from pyppeteer.network_manager import Request
+from pyppeteer.page import Page
+from requests_html import HTML
+
+import config
+from scraping import parse_branch_div, parse_org_name
+from utils import clean_text
+
+####
+## Browser utils
+####
+
+
+def get_user_agent():
+    ua = UserAgent(verify_ssl=False)
+    return ua.random
+
+
+class CookieStore:
+    """Cookies shared by all the pages of the process.
+
+    The cookies file is read once, pages cookies are merged in memory and
+    the file is rewritten atomically at most every flush_interval seconds.
+    """
+
+    def __init__(self, path: Path, flush_interval: int):
+        self.path = path
+        self.flush_interval = flush_interval
+        # (domain, path, name) -> cookie
+        self._cookies = {}
+        self._loaded = False
+        self._dirty = False
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r') as f:
+                cookies = json.load(f)
+        except ValueError:
+            # Truncated by a concurrent write of an older version
+            cookies = []
+        for cookie in cookies:
+            self._cookies[self._key(cookie)] = cookie
+
+    @staticmethod
+    def _key(cookie: dict) -> tuple:
+        return cookie.get('domain'), cookie.get('path'), cookie['name']
+
+    def get_all(self) -> list[dict]:
+        with self._lock:
+            self._load()
+            return list(self._cookies.values())
+
+    def merge(self, cookies: list[dict]):
+        with self._lock:
+            self._load()
+            for cookie in cookies:
+                self._cookies[self._key(cookie)] = cookie
+            self._dirty = True
+        if time.monotonic() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write the cookies to a temporary file then swap it in"""
+        with self._lock:
+            self._flushed_at = time.monotonic()
+            if not self._dirty:
+                return
+            tmp_path = self.path.with_name(f'{self.path.name}.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(list(self._cookies.values()), f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+
+
+cookie_store = CookieStore(Path(config.COOKIES_FILE),
+                           config.COOKIES_FLUSH_INTERVAL)
+atexit.register(cookie_store.flush)
+
+
+async def load_cookies(page: Page):
+    cookies = cookie_store.get_all()
+    if cookies:
+        await page.setCookie(*cookies)
+
+
+async def save_cookies(page: Page):
+    cookie_store.merge(await page.cookies())
+
+
+async def get_new_page(browser: Browser or None = None,
+                       page: Page or None = None) -> Page:
+    if browser is None and page is None:
+        raise RuntimeError('browser or page must be provided')
+    if browser:
+        page = await browser.newPage()
+    page.setDefaultNavigationTimeout(0)
+    await load_cookies(page)
+    return page
+
+
+async def safe_close_page(page):
+    pages = await page.browser.pages()
+    if len(pages) > 1:
+        await page.close()
+        return True
+    return False
+
+
+async def get_reviews_api_key(
+        reviews_url:
+    str = "https://2gis.ru/ufa/branches/2393075273031352/firm/70000001007027017/tab/reviews",
+        page: Page or None = None) -> str:
+    if page is None:
+        raise RuntimeError('page must be provided')
+    intercepted_request = None
+    page.on('request', lambda req: asyncio.ensure_future(intercept(req)))
+
+    async def intercept(request: Request):
+        nonlocal intercepted_request
+        if request.url.startswith(config.REVIEW_API_URL):
+            intercepted_request = request
+
+    # Navigate to the page where the request will be made
+    await page.goto(reviews_url)
+    await page.waitForRequest(lambda _: intercepted_request is not None)
+
+    parsed_url = urlparse(intercepted_request.url)
+    query_params = parse_qs(parsed_url.query)
+    # the key or an empty string
+    key = query_params.get('key', [''])[0]
+    return key
+
+
+####
+## Browser scrapers
+####
+
+
+async def _close_cookies_footer_if_needed(page: Page,
+                                          close_selector: str or None = None):
+    if close_selector is None:
+        close_selector = '._euwdl0'
+    close_btn = await page.querySelector(close_selector)
+    if close_btn is not None:
+        await close_btn.click()
+
+
+async def extract_branches_data_from_divs(
+        page: Page, divs: list[ElementHandle]) -> list[dict]:
+    """Extract branches links from divs"""
+
+    data = []
+    if not divs:
+        return data
+    org_name = None
+    for div in divs:
+        html = await page.evaluate('(element) => element.outerHTML', div)
+        div_element = lxml.html.fromstring(clean_text(html))
+        if org_name is None:
+            org_name = parse_org_name(div_element)
+        data.append(parse_branch_div(div_element, org_name))
+    return data
+
+
+async def _navigate_to_next_page(page: Page) -> bool:
+    """Navigate to the next page of the reviews"""
+    try:
+        active_btn_class = '_n5hmn94'
+        secont_btn_div = await page.querySelector('._5ocwns > *:nth-child(2)')
+        div_class = await page.evaluate("(node) => node.getAttribute('class')",
+                                        secont_btn_div)
+        if div_class == active_btn_class:
+            await secont_btn_div.click()
+            await page.waitForNavigation()
+            await page.waitForSelector('._5ocwns')
+            return True
+    except ElementHandleError:
+        # Navigation buttons don't exist
+        pass
+
+    return False
+
+
+async def _load_reviews(page: Page):
+    """Load all reviews into the html page"""
+    load_btn_class = '_1iczexgz'
+    load_btn = await page.querySelector(f'.{load_btn_class}')
+    try:
+        logging.info("Loading reviews into page")
+        while load_btn is not None:
+            await load_btn.click()
+            await asyncio.sleep(0.2)
+            load_btn = await page.querySelector(f'.{load_btn_class}')
+        logging.info('reviews loaded')
+    except ElementHandleError:
+        logging.warn('Loading failed, skipping...')
+
+
+async def get_review_data(page: Page, review: ElementHandle) -> dict:
+    """Get all data from a review"""
+    html = await page.evaluate('(element) => element.outerHTML', review)
+    return parse_review_html(html)
+
+
+def parse_review_html(html: str) -> dict:
+    """Get all data from the html of a review"""
+    html_object = HTML(html=clean_text(html))
+    # Scrape the commenter's name
+    name = html_object.find('div._1wz5xvq span._16s5yj36', first=True).text
+
+    # Scrape the date of the comment
+    date = html_object.find('div._4mwq3d', first=True).text
+
+    # Scrape the photos uploaded (if any)
+    photos = [img.attrs['src'] for img in html_object.find('img._1env6hv')]
+
+    # Scrape the comment
+    text = None
+    try:
+        text = html_object.find('div._49x36f a._ayej9u3', first=True).text
+    except AttributeError:
+        text = html_object.find('a._1it5ivp', first=True).text
+
+    # Scrape the reply (if any)
+    reply_element = html_object.find('div._sgs1pz', first=True)
+    reply = {}
+    if reply_element:
+        reply_name = reply_element.find('div._y7bbr0 span', first=True).text
+        reply_date = reply_element.find('div._1fw4r5p',
+                                        first=True).text.split(',')[0]
+        reply_text = reply_element.find('div._j1il10', first=True).text
+        reply = {
+            'org_name': clean_text(reply_name),
+            'date': reply_date,
+            'text': clean_text(reply_text)
+        }
+
+    return {
+        'name': name,
+        'date': date,
+        'photos': photos,
+        'text': clean_text(text),
+        'reply': reply
+    }
+
+
+async def get_branches_data(
+        page: Page,
+        city: Optional[str] = 'ufa',
+        company_name: Optional[str] = 'Вкусно — и точка') -> list[dict]:
+    """Get all branches links from 2gis.ru"""
+
+    branches_data = []
+    await page.goto(f'https://2gis.ru/{city}/search/{company_name}')
+    await page.waitForSelector('._1kf6gff')
+    await _close_cookies_footer_if_needed(page)
+
+    logging.info('Extracting branches data')
+    divs = await page.querySelectorAll('._1kf6gff')
+    branches_data.extend(await extract_branches_data_from_divs(page, divs))
+    while await _navigate_to_next_page(page):
+        divs = await page.querySelectorAll('._1kf6gff')
+        branches_data.extend(await extract_branches_data_from_divs(page, divs))
+    logging.info(f"Extracted {len(branches_data)} branches' data")
+
+    await save_cookies(page)
+    await safe_close_page(page)
+    return branches_data
+
+
+def safe_scrape(scraper_function,
+                semaphore: asyncio.Semaphore = asyncio.Semaphore(3)):
+
+    async def runner(*args, **kwargs):
+        async with semaphore:
+            await scraper_function(*args, **kwargs)
+
+    return runner
+
+
+@safe_scrape
+async def scrape_branch_reviews(branch_data: dict,
+                                page: Page or None = None,
+                                browser: Browser or None = None,
+                                ensure_reviews_loaded: Optional[bool] = True):
+    """Scrape reviews from a branch"""
+    if page is None and browser is None:
+        raise RuntimeError('At least one of page or browser must be provided')
+    if page is None:
+        page = await get_new_page(browser)
+
+    try:
+        await page.goto(f"https://2gis.ru{branch_data['link']}/tab/reviews",
+                        {'waitUntil': "domcontentloaded"})
+
+        logging.info(f"Extracting reviews from {branch_data['name']}")
+
+        if ensure_reviews_loaded:
+            await _load_reviews(page)
+
+        divs = await page.querySelectorAll('._11gvyqv')
+        reviews = []
+        for div in divs:
+            review = await get_review_data(page, div)
+            reviews.append(review)
+
+        logging.info(
+            f"extracted {len(reviews)} reviews from {branch_data['name']}")
+
+        await save_cookies(page)
+
+    finally:
+        await page.close()
+        return reviews
+
+
+async def record_reviews_page(browser: Browser, link: str) -> str:
+    """Html of a branch reviews tab with all its reviews loaded"""
+    page = await get_new_page(browser)
+    try:
+        await page.goto(f"https://2gis.ru{link}/tab/reviews",
+                        {'waitUntil': "domcontentloaded"})
+        await _load_reviews(page)
+        return await page.content()
+    finally:
+        await page.close()
@@ -0,0 +1,50 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class TTLCache:
+    """Read-through cache for coroutines.
+
+    Values expire after ttl seconds. Concurrent misses on a key share a
+    single load, and a load started before the key was invalidated or put
+    does not overwrite the newer value.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        # key -> (expires_at, value)
+        self._values = {}
+        self._loads = {}
+        self._generations = {}
+
+    async def get(self, key: Hashable,
+                  loader: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self._values.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        load = self._loads.get(key)
+        if load is None:
+            load = asyncio.ensure_future(self._load(key, loader))
+            self._loads[key] = load
+        # A cancelled waiter must not cancel the load shared with the others
+        return await asyncio.shield(load)
+
+    async def _load(self, key: Hashable, loader: Callable[[],
+                                                           Awaitable[Any]]):
+        generation = self._generations.get(key, 0)
+        try:
+            value = await loader()
+        finally:
+            del self._loads[key]
+        if self._generations.get(key, 0) == generation:
+            self._values[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        self.invalidate(key)
+        self._values[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, key: Hashable):
+        self._generations[key] = self._generations.get(key, 0) + 1
+        self._values.pop(key, None)
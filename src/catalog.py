@@ -0,0 +1,112 @@
+"""Keep the branches of known companies up to date
+
+    python src/catalog.py
+
+Each company is searched again with the query it was found with, or its
+name when it was stored before queries were kept. Only the differences
+with the stored branches are written.
+"""
+import datetime
+import logging
+
+from pymongo import UpdateOne
+
+import config
+import db
+from scraping import get_branches_in_cities
+
+companies_db = db.get_companies_collection()
+branches_db = db.get_branches_collection()
+
+
+def diff_branches(company: dict, stored: list[dict],
+                  scraped: list[dict]) -> dict[str, dict]:
+    """Fields to set on each branch to turn the stored branches of a company
+    into the scraped ones, missing branches are marked as closed"""
+    stored = {branch['id']: branch for branch in stored}
+    scraped = {branch['id']: branch for branch in scraped}
+    changes = {}
+    for branch_id, branch in scraped.items():
+        fields = {
+            'name': branch['name'],
+            'link': branch['link'],
+            'city': branch['city']
+        }
+        old_branch = stored.get(branch_id)
+        if old_branch is None or old_branch.get('closed') or any(
+                old_branch.get(key) != value for key, value in fields.items()):
+            changes[branch_id] = {**fields, 'closed': False}
+
+    closed_ids = [
+        branch_id for branch_id, branch in stored.items()
+        if branch_id not in scraped and not branch.get('closed')
+    ]
+    if len(closed_ids) > len(stored) * config.CATALOG_MAX_CLOSED_RATIO:
+        # More likely an incomplete scrape than a wave of closures
+        logging.warning(f"Not closing {len(closed_ids)} of {len(stored)} "
+                        f"branches of {company['name']}")
+        closed_ids = []
+    now = datetime.datetime.now()
+    for branch_id in closed_ids:
+        changes[branch_id] = {'closed': True, 'closed_at': now}
+    return changes
+
+
+def refresh_company_branches(company: dict) -> int:
+    """Re-scrape the branches of a company, return the number of changes"""
+    # Companies stored before searches were kept are searched by name
+    scraped = get_branches_in_cities(company.get('query') or company['name'],
+                                     config.CITIES)
+    if not scraped or scraped[0]['org_name'] != company['name']:
+        logging.warning(f"Search results changed for {company['name']}")
+        return 0
+    for branch in scraped:
+        branch.pop('org_name')
+
+    stored = list(
+        branches_db.find({'company._id': company['_id']}, {
+            'id': 1,
+            'name': 1,
+            'link': 1,
+            'city': 1,
+            'closed': 1
+        }))
+    # A city whose search failed has no results, its branches stay open
+    searched_cities = {branch['city'] for branch in scraped}
+    scraped_ids = {branch['id'] for branch in scraped}
+    stored = [
+        branch for branch in stored
+        if branch.get('city') in searched_cities or branch['id'] in scraped_ids
+    ]
+    changes = diff_branches(company, stored, scraped)
+    if not changes:
+        return 0
+    branches_db.bulk_write([
+        UpdateOne({'id': branch_id}, {
+            '$set': fields,
+            '$setOnInsert': {
+                'company': db.company_reference(company)
+            }
+        },
+                  upsert=True) for branch_id, fields in changes.items()
+    ],
+                           ordered=False)
+    logging.info(f"Applied {len(changes)} changes to {company['name']}")
+    return len(changes)
+
+
+def refresh_catalogs() -> int:
+    """Refresh every known company"""
+    changes = 0
+    for company in companies_db.find():
+        try:
+            changes += refresh_company_branches(company)
+        except Exception as e:
+            logging.error(f"Refresh of {company['name']} failed: {e}")
+    return changes
+
+
+if __name__ == '__main__':
+    format = "%(levelname)s:%(asctime)s:%(message)s"
+    logging.basicConfig(format=format, level=logging.INFO, datefmt="%H:%M:%S")
+    logging.info(f'Applied {refresh_catalogs()} changes')
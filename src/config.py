@@ -8,11 +8,80 @@ load_dotenv()
 REVIEW_API_URL = "https://public-api.reviews.2gis.com/2.0/branches"
 REVIEW_KEY = os.getenv('REVIEW_KEY', '')
 SENDING_INTERVAL = int(os.getenv('SENDING_INTERVAL', 60 * 30))
+# Seconds a company search result stays available for confirmation
+SEARCH_TTL = int(os.getenv('SEARCH_TTL', 60 * 60))
+# Cities companies are searched in, 2gis url names, comma separated
+CITIES = [c for c in os.getenv('CITIES', 'ufa').split(',') if c]
+# 2gis search pages requests per second, shared by all cities
+SEARCH_RATE = float(os.getenv('SEARCH_RATE', 3))
+SEARCH_WORKERS = int(os.getenv('SEARCH_WORKERS', 8))
+SEARCH_RETRIES = int(os.getenv('SEARCH_RETRIES', 5))
+# Seconds the latest reviews of a branch are served from memory
+REVIEWS_CACHE_TTL = int(os.getenv('REVIEWS_CACHE_TTL', 60 * 5))
+# Reviews api requests per second of the live poller
+API_RATE = float(os.getenv('API_RATE', 5))
+# History backfill, kept well below the poller's rate
+BACKFILL_RATE = float(os.getenv('BACKFILL_RATE', 1))
+BACKFILL_WORKERS = int(os.getenv('BACKFILL_WORKERS', 4))
+BACKFILL_PAGE_SIZE = int(os.getenv('BACKFILL_PAGE_SIZE', 50))
+# Companies branches are searched again every CATALOG_REFRESH_INTERVAL seconds,
+# refreshes closing more than this share of the branches are not trusted
+CATALOG_REFRESH_INTERVAL = int(os.getenv('CATALOG_REFRESH_INTERVAL',
+                                         60 * 60 * 24))
+CATALOG_MAX_CLOSED_RATIO = float(os.getenv('CATALOG_MAX_CLOSED_RATIO', 0.5))
+
+# Reviews older than REVIEWS_RETENTION_DAYS (0 keeps them) are moved to the
+# archive collection ('archive') or deleted by a mongo TTL index ('expire')
+REVIEWS_RETENTION_DAYS = int(os.getenv('REVIEWS_RETENTION_DAYS', 0))
+REVIEWS_RETENTION_MODE = os.getenv('REVIEWS_RETENTION_MODE', 'archive')
+# Photo urls of reviews older than this are dropped, their ids are kept
+PHOTOS_RETENTION_DAYS = int(os.getenv('PHOTOS_RETENTION_DAYS', 30))
+RETENTION_INTERVAL = int(os.getenv('RETENTION_INTERVAL', 60 * 60 * 24))
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', 1000))
+# Deliveries of new reviews are queued in the outbox and sent every
+# OUTBOX_INTERVAL seconds by any replica. A replica leases a user to send up
+# to OUTBOX_CLAIM_SIZE deliveries, the lease is renewed after each sent
+# message and taken over once not renewed for OUTBOX_LEASE seconds. A
+# delivery failing OUTBOX_MAX_ATTEMPTS times is given up. Sent and given up
+# deliveries are removed after OUTBOX_RETENTION seconds, pending ones stay
+OUTBOX_INTERVAL = int(os.getenv('OUTBOX_INTERVAL', 60))
+OUTBOX_LEASE = int(os.getenv('OUTBOX_LEASE', 60 * 5))
+OUTBOX_CLAIM_SIZE = int(os.getenv('OUTBOX_CLAIM_SIZE', 100))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+OUTBOX_RETENTION = int(os.getenv('OUTBOX_RETENTION', 60 * 60 * 24 * 7))
+# Reviews written per chunk by exports
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 5000))
+
+# Browser cookies, kept in memory and written to COOKIES_FILE every
+# COOKIES_FLUSH_INTERVAL seconds and at exit
+COOKIES_FILE = os.getenv('COOKIES_FILE', 'cookies.json')
+COOKIES_FLUSH_INTERVAL = int(os.getenv('COOKIES_FLUSH_INTERVAL', 60))
+
+# Profiling, the next PROFILE_RUNS runs of the PROFILE_NAMES jobs and
+# handlers are sampled, runs slower than the thresholds (seconds) are logged
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'data/profiles')
+PROFILE_NAMES = [n for n in os.getenv('PROFILE_NAMES', '').split(',') if n]
+PROFILE_RUNS = int(os.getenv('PROFILE_RUNS', 1))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', 0.005))
+SLOW_CYCLE_THRESHOLD = float(os.getenv('SLOW_CYCLE_THRESHOLD', 5 * 60))
+SLOW_HANDLER_THRESHOLD = float(os.getenv('SLOW_HANDLER_THRESHOLD', 10))
 
 # Telegram
 TG_TOKEN = os.getenv('TG_TOKEN', '')
 SECRET_KEY = os.getenv('SECRET_KEY')
 TG_LINK = os.getenv('TG_LINK', '')
+# Telegram ids allowed to run admin commands, comma separated
+ADMIN_IDS = [int(i) for i in os.getenv('ADMIN_IDS', '').split(',') if i]
+# Updates handled at the same time, updates of one chat stay sequential
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', 16))
+# Webhook, the bot falls back to polling when WEBHOOK_URL is empty
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+# Checked against the X-Telegram-Bot-Api-Secret-Token header, 1-256 of
+# A-Z, a-z, 0-9, _ and -
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
 
 # Database
 MONGO_URI = os.getenv('MONGO_URI')
@@ -1,10 +1,15 @@
 import datetime
+import uuid
 
 import pymongo
+from dateutil.parser import isoparse
+from pymongo import UpdateOne
 from pymongo.collection import Collection
 from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
 
 import config
+from models import Review
 
 
 def get_db() -> Database:
@@ -16,14 +21,86 @@ def get_db() -> Database:
 def get_reviews_collection(db: Database = get_db()) -> Collection:
 
     reviews_db = db.reviews
-    if 'id' not in reviews_db.index_information():
+    indexes = reviews_db.index_information()
+    if 'id' not in indexes:
         reviews_db.create_index(
             [('id', pymongo.ASCENDING)],
             unique=True,
         )
+    if 'branch_id_1_created_at_-1' not in indexes:
+        reviews_db.create_index([('branch_id', pymongo.ASCENDING),
+                                 ('created_at', pymongo.DESCENDING)])
+    if 'text_text' not in indexes:
+        reviews_db.create_index([('text', 'text')],
+                                default_language='russian')
+    _sync_reviews_ttl(reviews_db, indexes)
     return reviews_db
 
 
+def _sync_reviews_ttl(reviews_db: Collection, indexes: dict):
+    """Expire reviews after REVIEWS_RETENTION_DAYS in the expire mode, the
+    created_at index stays a plain one otherwise"""
+    ttl = None
+    if (config.REVIEWS_RETENTION_DAYS
+            and config.REVIEWS_RETENTION_MODE == 'expire'):
+        ttl = config.REVIEWS_RETENTION_DAYS * 24 * 60 * 60
+    index = indexes.get('created_at_1')
+    if ttl is None:
+        if index is not None and 'expireAfterSeconds' in index:
+            reviews_db.drop_index('created_at_1')
+            index = None
+        if index is None:
+            # Used by the archival, the photos compaction and exports
+            reviews_db.create_index([('created_at', pymongo.ASCENDING)])
+    elif index is None or 'expireAfterSeconds' not in index:
+        if index is not None:
+            reviews_db.drop_index('created_at_1')
+        reviews_db.create_index([('created_at', pymongo.ASCENDING)],
+                                expireAfterSeconds=ttl)
+    elif index['expireAfterSeconds'] != ttl:
+        reviews_db.database.command('collMod',
+                                    reviews_db.name,
+                                    index={
+                                        'keyPattern': {
+                                            'created_at': 1
+                                        },
+                                        'expireAfterSeconds': ttl
+                                    })
+
+
+def get_reviews_archive_collection(db: Database = get_db()) -> Collection:
+    """Reviews moved out of the reviews collection by the retention"""
+    archive_db = db.reviews_archive
+    if 'id_1' not in archive_db.index_information():
+        archive_db.create_index(
+            [('id', pymongo.ASCENDING)],
+            unique=True,
+        )
+    return archive_db
+
+
+def get_branch_stats_collection(db: Database = get_db()) -> Collection:
+    """Ratings aggregates, one document per branch"""
+    stats_db = db.branch_stats
+    if 'branch_id_1' not in stats_db.index_information():
+        stats_db.create_index(
+            [('branch_id', pymongo.ASCENDING)],
+            unique=True,
+        )
+    return stats_db
+
+
+def get_backfills_collection(db: Database = get_db()) -> Collection:
+    """History backfill checkpoints, one per branch"""
+    backfills_db = db.backfills
+    if 'branch_id_1' not in backfills_db.index_information():
+        backfills_db.create_index(
+            [('branch_id', pymongo.ASCENDING)],
+            unique=True,
+        )
+    return backfills_db
+
+
 def get_branches_collection(db: Database = get_db()) -> Collection:
     branches_db = db.branches
     if 'id' not in branches_db.index_information():
@@ -44,6 +121,48 @@ def get_companies_collection(db: Database = get_db()) -> Collection:
     return companies_db
 
 
+def get_searches_collection(db: Database = get_db()) -> Collection:
+    """Company search results, expired by mongo after SEARCH_TTL seconds"""
+    searches_db = db.searches
+    if 'created_at_1' not in searches_db.index_information():
+        searches_db.create_index(
+            [('created_at', pymongo.ASCENDING)],
+            expireAfterSeconds=config.SEARCH_TTL,
+        )
+    return searches_db
+
+
+def get_outbox_collection(db: Database = get_db()) -> Collection:
+    """Pending deliveries, one document per review and user"""
+    outbox_db = db.outbox
+    indexes = outbox_db.index_information()
+    if 'status_1_created_at_1' not in indexes:
+        outbox_db.create_index([('status', pymongo.ASCENDING),
+                                ('created_at', pymongo.ASCENDING)])
+    if 'user_id_1_status_1_created_at_1' not in indexes:
+        outbox_db.create_index([('user_id', pymongo.ASCENDING),
+                                ('status', pymongo.ASCENDING),
+                                ('created_at', pymongo.ASCENDING)])
+    if 'created_at_1' in indexes:
+        # Expired pending deliveries too
+        outbox_db.drop_index('created_at_1')
+    # Only sent and given up deliveries have these dates, pending ones
+    # never expire
+    for field in ('sent_at', 'failed_at'):
+        if f'{field}_1' not in indexes:
+            outbox_db.create_index(
+                [(field, pymongo.ASCENDING)],
+                expireAfterSeconds=config.OUTBOX_RETENTION,
+            )
+    return outbox_db
+
+
+def get_outbox_leases_collection(db: Database = get_db()) -> Collection:
+    """Users whose deliveries are being sent, keyed by user id so only one
+    replica at a time sends to a user"""
+    return db.outbox_leases
+
+
 def get_users_collection(db: Database = get_db()) -> Collection:
     users_db = db.users
     if 'id' not in users_db.index_information():
@@ -54,25 +173,278 @@ def get_users_collection(db: Database = get_db()) -> Collection:
     return users_db
 
 
+def save_reviews(reviews_db: Collection,
+                 reviews: list[Review]) -> list[Review]:
+    """Store reviews, return the ones that were not stored yet"""
+    if config.REVIEWS_RETENTION_DAYS:
+        # Past the retention, they would be counted again once removed
+        since = datetime.datetime.now(
+            datetime.timezone.utc) - datetime.timedelta(
+                days=config.REVIEWS_RETENTION_DAYS)
+        reviews = [
+            review for review in reviews if isoparse(review.date) >= since
+        ]
+    if not reviews:
+        return []
+    operations = [
+        UpdateOne({'id': review.id}, {
+            '$setOnInsert': {
+                **review.to_document(), 'created_at': isoparse(review.date)
+            }
+        },
+                  upsert=True) for review in reviews
+    ]
+    result = reviews_db.bulk_write(operations, ordered=False)
+    return [reviews[i] for i in result.upserted_ids]
+
+
+def update_branch_stats(stats_db: Collection, reviews: list[Review]):
+    """Add reviews to their branch ratings count, distribution and daily
+    buckets. Each review must be counted only once."""
+    increments = {}
+    for review in reviews:
+        inc = increments.setdefault(review.branch_id, {})
+        day = isoparse(review.date).date().isoformat()
+        for field, value in (('count', 1), ('rating_sum', review.rating),
+                             (f'ratings.{review.rating}', 1),
+                             (f'days.{day}.count', 1),
+                             (f'days.{day}.rating_sum', review.rating)):
+            inc[field] = inc.get(field, 0) + value
+    if not increments:
+        return
+    stats_db.bulk_write([
+        UpdateOne({'branch_id': branch_id}, {'$inc': inc}, upsert=True)
+        for branch_id, inc in increments.items()
+    ],
+                        ordered=False)
+
+
+def ingest_reviews(reviews_db: Collection, stats_db: Collection,
+                   reviews: list[Review]) -> list[Review]:
+    """Store reviews and count the new ones in the branch stats"""
+    new_reviews = save_reviews(reviews_db, reviews)
+    update_branch_stats(stats_db, new_reviews)
+    return new_reviews
+
+
+def delivery_id(review_id: str, user_id: int) -> str:
+    return f'{review_id}:{user_id}'
+
+
+def enqueue_deliveries(outbox_db: Collection, user_ids: list,
+                       reviews: list[Review], branch_name: str,
+                       company_name: str):
+    """Queue reviews for users, a delivery queued twice is sent once"""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    operations = [
+        UpdateOne({'_id': delivery_id(review.id, user_id)}, {
+            '$setOnInsert': {
+                'user_id': user_id,
+                'branch_id': review.branch_id,
+                'branch_name': branch_name,
+                'company_name': company_name,
+                'review': review.to_document(),
+                'status': 'pending',
+                'attempts': 0,
+                'created_at': now
+            }
+        },
+                  upsert=True) for user_id in user_ids for review in reviews
+    ]
+    if operations:
+        outbox_db.bulk_write(operations, ordered=False)
+
+
+def _lease_expires_at() -> datetime.datetime:
+    return datetime.datetime.now(
+        datetime.timezone.utc) + datetime.timedelta(seconds=config.OUTBOX_LEASE)
+
+
+def claim_deliveries(outbox_db: Collection, leases_db: Collection,
+                     skipped_user_ids: list) -> tuple[str, list[dict]]:
+    """Lease the user with the oldest pending delivery, return the claim and
+    up to OUTBOX_CLAIM_SIZE of their deliveries in the order they were
+    queued. Users leased by another claim, or drained by one meanwhile, are
+    added to skipped_user_ids."""
+    claim = uuid.uuid4().hex
+    while True:
+        first = outbox_db.find_one(
+            {
+                'status': 'pending',
+                'user_id': {
+                    '$nin': skipped_user_ids
+                }
+            },
+            sort=[('created_at', pymongo.ASCENDING)])
+        if first is None:
+            return claim, []
+        user_id = first['user_id']
+        try:
+            # Inserts the lease or takes over an expired one, a live lease
+            # makes the insert fail on its _id
+            leases_db.update_one(
+                {
+                    '_id': user_id,
+                    'expires_at': {
+                        '$lt': datetime.datetime.now(datetime.timezone.utc)
+                    }
+                }, {'$set': {
+                    'claim': claim,
+                    'expires_at': _lease_expires_at()
+                }},
+                upsert=True)
+        except DuplicateKeyError:
+            skipped_user_ids.append(user_id)
+            continue
+        deliveries = list(
+            outbox_db.find({
+                'user_id': user_id,
+                'status': 'pending'
+            }).sort([('created_at', pymongo.ASCENDING),
+                     ('_id', pymongo.ASCENDING)]).limit(
+                         config.OUTBOX_CLAIM_SIZE))
+        if not deliveries:
+            # Drained by another claim between the lookup and the lease
+            leases_db.delete_one({'_id': user_id, 'claim': claim})
+            skipped_user_ids.append(user_id)
+            continue
+        return claim, deliveries
+
+
+class LeaseLostError(Exception):
+    """The lease of a user was taken over by another replica"""
+
+
+def renew_claim(leases_db: Collection, user_id: int, claim: str) -> bool:
+    """Extend the lease of a user, False if it was taken over"""
+    result = leases_db.update_one({
+        '_id': user_id,
+        'claim': claim
+    }, {'$set': {
+        'expires_at': _lease_expires_at()
+    }})
+    return result.matched_count == 1
+
+
+def ack_deliveries(outbox_db: Collection, ids: list[str]):
+    """Mark deliveries as sent"""
+    outbox_db.update_many({
+        '_id': {
+            '$in': ids
+        },
+        'status': 'pending'
+    }, {
+        '$set': {
+            'status': 'sent',
+            'sent_at': datetime.datetime.now(datetime.timezone.utc)
+        }
+    })
+
+
+def release_claim(outbox_db: Collection,
+                  leases_db: Collection,
+                  user_id: int,
+                  claim: str,
+                  failed_ids: list[str] = ()):
+    """End the lease of a user. The failed deliveries not sent yet are
+    retried by a later claim, or given up once they failed too often."""
+    if failed_ids:
+        attempts = {'$add': ['$attempts', 1]}
+        given_up = {'$gte': [attempts, config.OUTBOX_MAX_ATTEMPTS]}
+        outbox_db.update_many(
+            {
+                '_id': {
+                    '$in': list(failed_ids)
+                },
+                'status': 'pending'
+            }, [{
+                '$set': {
+                    'attempts': attempts,
+                    'status': {
+                        '$cond': [given_up, 'failed', 'pending']
+                    },
+                    'failed_at': {
+                        '$cond': [given_up, '$$NOW', '$$REMOVE']
+                    }
+                }
+            }])
+    leases_db.delete_one({'_id': user_id, 'claim': claim})
+
+
+def search_reviews(reviews_db: Collection,
+                   text: str,
+                   branch_ids: list[str],
+                   limit: int = 10) -> list[Review]:
+    """Full text search among the stored reviews of branches"""
+    cursor = reviews_db.find(
+        {
+            '$text': {
+                '$search': text
+            },
+            'branch_id': {
+                '$in': branch_ids
+            }
+        }, {
+            'score': {
+                '$meta': 'textScore'
+            }
+        }).sort([('score', {
+            '$meta': 'textScore'
+        })]).limit(limit)
+    return [Review.from_document(document) for document in cursor]
+
+
+def company_reference(company: dict) -> dict:
+    """Part of a company embedded in its branches"""
+    return {'_id': company['_id'], 'name': company['name']}
+
+
+def get_user_branches(branches_db: Collection, user: dict) -> list[dict]:
+    """Branches a user is subscribed to, users only keep their ids"""
+    ids = [branch['id'] for branch in user['branches']]
+    branches = {
+        branch['id']: branch
+        for branch in branches_db.find({'id': {
+            '$in': ids
+        }})
+    }
+    return [branches[branch_id] for branch_id in ids if branch_id in branches]
+
+
 def get_branches_with_users(users_db: Database):
     """Get branches along with users subscribed to them"""
     pipeline = [{
         "$unwind": "$branches"
+    }, {
+        "$lookup": {
+            "from": "branches",
+            "localField": "branches.id",
+            "foreignField": "id",
+            "as": "branch"
+        }
+    }, {
+        "$unwind": "$branch"
     }, {
         "$match": {
-            "branches.company": {
+            "branch.company": {
                 "$exists": True
+            },
+            "branch.closed": {
+                "$ne": True
             }
         }
     }, {
         "$group": {
             "_id": {
-                "branch_id": "$branches.id",
-                "branch_name": "$branches.name",
-                "company": "$branches.company.name"
+                "branch_id": "$branch.id",
+                "branch_name": "$branch.name",
+                "company": "$branch.company.name"
             },
             "user_ids": {
                 "$addToSet": "$id"
+            },
+            "sent_until": {
+                "$first": "$branch.sent_until"
             }
         }
     }, {
@@ -81,7 +453,8 @@ def get_branches_with_users(users_db: Database):
             "branch_id": "$_id.branch_id",
             "branch_name": "$_id.branch_name",
             "company": "$_id.company",
-            "user_ids": 1
+            "user_ids": 1,
+            "sent_until": 1
         }
     }]
     return list(users_db.aggregate(pipeline))
@@ -0,0 +1,179 @@
+"""Export stored reviews
+
+    python src/export.py --output reviews.jsonl.gz [--format jsonl|csv|parquet]
+                         [--company NAME ...] [--branch ID ...]
+                         [--since 2023-01-01] [--until 2024-01-01]
+
+Reviews are streamed from a cursor and written in chunks, memory use does
+not depend on the number of exported reviews. jsonl and csv are gzipped,
+parquet needs pyarrow and is compressed with zstd.
+"""
+import argparse
+import csv
+import datetime
+import gzip
+import itertools
+import logging
+from pathlib import Path
+from typing import Iterator, Optional
+
+import msgspec
+
+import config
+import db
+
+FORMATS = ('jsonl', 'csv', 'parquet')
+# Flat columns of the csv and parquet exports
+COLUMNS = ('id', 'company', 'branch_id', 'branch', 'name', 'rating', 'date',
+           'text', 'photos', 'reply_text')
+
+reviews_db = db.get_reviews_collection()
+branches_db = db.get_branches_collection()
+
+
+def _query(companies: Optional[list[str]], branch_ids: Optional[list[str]],
+           since: Optional[datetime.datetime],
+           until: Optional[datetime.datetime]) -> dict:
+    query = {}
+    if companies or branch_ids:
+        selected = set(branch_ids or [])
+        if companies:
+            selected.update(
+                branches_db.distinct('id', {'company.name': {
+                    '$in': companies
+                }}))
+        query['branch_id'] = {'$in': list(selected)}
+    if since or until:
+        query['created_at'] = {}
+        if since:
+            query['created_at']['$gte'] = since
+        if until:
+            query['created_at']['$lt'] = until
+    return query
+
+
+def _chunks(cursor, size: int) -> Iterator[list[dict]]:
+    while True:
+        chunk = list(itertools.islice(cursor, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _flatten(review: dict, branches: dict) -> dict:
+    branch = branches.get(review['branch_id'], {})
+    reply = review.get('reply') or {}
+    return {
+        'id': review['id'],
+        'company': branch.get('company', {}).get('name'),
+        'branch_id': review['branch_id'],
+        'branch': branch.get('name'),
+        'name': review['name'],
+        'rating': review['rating'],
+        'date': review['date'],
+        'text': review['text'],
+        'photos': ' '.join(review.get('photos', [])),
+        'reply_text': reply.get('text')
+    }
+
+
+def _write_jsonl(output: Path, chunks: Iterator[list[dict]], branches: dict):
+    encoder = msgspec.json.Encoder()
+    with gzip.open(output, 'wb') as f:
+        for chunk in chunks:
+            f.write(b''.join(
+                encoder.encode(review) + b'\n' for review in chunk))
+
+
+def _write_csv(output: Path, chunks: Iterator[list[dict]], branches: dict):
+    with gzip.open(output, 'wt', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        for chunk in chunks:
+            writer.writerows(_flatten(review, branches) for review in chunk)
+
+
+def _write_parquet(output: Path, chunks: Iterator[list[dict]],
+                   branches: dict):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError('pyarrow is required for parquet exports')
+
+    schema = pa.schema([(column, pa.int64() if column == 'rating' else
+                         pa.string()) for column in COLUMNS])
+    with pq.ParquetWriter(output, schema, compression='zstd') as writer:
+        for chunk in chunks:
+            # One row group per chunk
+            writer.write_table(
+                pa.Table.from_pylist(
+                    [_flatten(review, branches) for review in chunk],
+                    schema=schema))
+
+
+WRITERS = {
+    'jsonl': _write_jsonl,
+    'csv': _write_csv,
+    'parquet': _write_parquet
+}
+
+
+def export_reviews(output: Path,
+                   format: str = 'jsonl',
+                   companies: Optional[list[str]] = None,
+                   branch_ids: Optional[list[str]] = None,
+                   since: Optional[datetime.datetime] = None,
+                   until: Optional[datetime.datetime] = None) -> int:
+    """Write the selected reviews to output, return their number"""
+    query = _query(companies, branch_ids, since, until)
+    branches = {
+        branch['id']: branch
+        for branch in branches_db.find({}, {
+            '_id': 0,
+            'id': 1,
+            'name': 1,
+            'company.name': 1
+        })
+    }
+    cursor = reviews_db.find(query, {
+        '_id': 0,
+        'created_at': 0
+    }).batch_size(config.EXPORT_CHUNK_SIZE)
+    exported = 0
+
+    def counted(chunks):
+        nonlocal exported
+        for chunk in chunks:
+            exported += len(chunk)
+            yield chunk
+
+    try:
+        WRITERS[format](output, counted(_chunks(cursor,
+                                                config.EXPORT_CHUNK_SIZE)),
+                        branches)
+    finally:
+        cursor.close()
+    logging.info(f'Exported {exported} reviews to {output}')
+    return exported
+
+
+def main():
+    format = "%(levelname)s:%(asctime)s:%(message)s"
+    logging.basicConfig(format=format, level=logging.INFO, datefmt="%H:%M:%S")
+
+    parser = argparse.ArgumentParser(description='Export stored reviews')
+    parser.add_argument('--output', required=True, type=Path)
+    parser.add_argument('--format', choices=FORMATS, default='jsonl')
+    parser.add_argument('--company', action='append', dest='companies')
+    parser.add_argument('--branch', action='append', dest='branch_ids')
+    parser.add_argument('--since', type=datetime.datetime.fromisoformat)
+    parser.add_argument('--until', type=datetime.datetime.fromisoformat)
+    args = parser.parse_args()
+
+    export_reviews(args.output, args.format, args.companies, args.branch_ids,
+                   args.since, args.until)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,15 @@
 import locale
 import logging
+import re
 
 from pathlib import Path
 from telegram import Update
 from telegram.ext import ApplicationBuilder, PicklePersistence
 
-from bot import setup
-from config import TG_TOKEN
+from bot import setup, teardown
+from config import (CONCURRENT_UPDATES, TG_TOKEN, WEBHOOK_LISTEN, WEBHOOK_PATH,
+                    WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_URL)
+from updates import PerChatUpdateProcessor
 
 
 def main():
@@ -23,9 +26,24 @@ def main():
     persistence_path.parent.mkdir(parents=True, exist_ok=True)
     persistence = PicklePersistence(filepath=persistence_path)
     app = ApplicationBuilder().token(TG_TOKEN).persistence(
-        persistence).arbitrary_callback_data(True).build()
+        persistence).concurrent_updates(
+            PerChatUpdateProcessor(CONCURRENT_UPDATES)).post_shutdown(
+                teardown).build()
     setup(app)
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        if WEBHOOK_SECRET and not re.fullmatch(r'[A-Za-z0-9_-]{1,256}',
+                                               WEBHOOK_SECRET):
+            raise ValueError('WEBHOOK_SECRET may only contain A-Z, a-z, '
+                             '0-9, _ and -, up to 256 characters')
+        # Served behind a reverse proxy terminating TLS
+        app.run_webhook(listen=WEBHOOK_LISTEN,
+                        port=WEBHOOK_PORT,
+                        url_path=WEBHOOK_PATH,
+                        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                        secret_token=WEBHOOK_SECRET or None,
+                        allowed_updates=Update.ALL_TYPES)
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,73 @@
+from typing import Optional
+
+import msgspec
+
+####
+## Reviews API payload, only the fields we use are decoded
+####
+
+
+class _User(msgspec.Struct, gc=False):
+    name: str = ''
+
+
+class _PreviewUrls(msgspec.Struct, gc=False):
+    url: str
+
+
+class _Photo(msgspec.Struct, gc=False):
+    preview_urls: _PreviewUrls
+    id: Optional[str] = None
+
+
+class Reply(msgspec.Struct, gc=False):
+    """Official answer of the company to a review"""
+    org_name: Optional[str] = None
+    text: Optional[str] = None
+    date_created: Optional[str] = None
+
+
+class ApiReview(msgspec.Struct, gc=False):
+    id: str
+    rating: int
+    date_created: str
+    user: _User = msgspec.field(default_factory=_User)
+    text: Optional[str] = None
+    photos: list[_Photo] = []
+    official_answer: Optional[Reply] = None
+
+
+class _Meta(msgspec.Struct, gc=False):
+    next_link: Optional[str] = None
+
+
+class ReviewsPage(msgspec.Struct, gc=False):
+    reviews: list[ApiReview] = []
+    meta: _Meta = msgspec.field(default_factory=_Meta)
+
+
+reviews_page_decoder = msgspec.json.Decoder(ReviewsPage)
+
+####
+## Review shared by scraping, db and utils
+####
+
+
+class Review(msgspec.Struct, gc=False):
+    id: str
+    branch_id: str
+    name: str
+    rating: int
+    text: str
+    date: str
+    photos: list[str] = []
+    # Kept once the urls of old reviews are compacted away
+    photo_ids: list[str] = []
+    reply: Optional[Reply] = None
+
+    def to_document(self) -> dict:
+        return msgspec.to_builtins(self)
+
+    @classmethod
+    def from_document(cls, document: dict) -> 'Review':
+        return msgspec.convert(document, cls)
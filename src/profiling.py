@@ -0,0 +1,122 @@
+"""Opt-in sampling profiler for jobs and handlers
+
+Profiled coroutines are timed on every call, calls slower than their
+threshold are written to the slow log. When armed, the next runs of a
+coroutine are sampled and written as collapsed stacks, the input format of
+flamegraph.pl, speedscope and friends.
+"""
+import datetime
+import functools
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+import config
+
+profile_dir = Path(config.PROFILE_DIR)
+
+# Profiled coroutine name -> number of next runs to sample
+armed_runs = {}
+
+slow_logger = logging.getLogger('slow')
+
+
+def arm(name: str, runs: int):
+    armed_runs[name] = runs
+
+
+def _setup_slow_logger():
+    if slow_logger.handlers:
+        return
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    handler = logging.FileHandler(profile_dir / 'slow.log')
+    handler.setFormatter(logging.Formatter("%(asctime)s:%(message)s"))
+    slow_logger.addHandler(handler)
+
+
+def _is_idle(frame) -> bool:
+    """Threads waiting on a lock or for io, and thread pool workers waiting
+    for work"""
+    code = frame.f_code
+    filename = Path(code.co_filename).name
+    if code.co_name in ('wait', 'select', 'poll') and filename in (
+            'threading.py', 'selectors.py'):
+        return True
+    # Blocked in SimpleQueue.get, which is implemented in C and has no frame
+    return code.co_name == '_worker' and filename == 'thread.py'
+
+
+class Sampler(threading.Thread):
+    """Sample the stacks of every thread of the process"""
+
+    def __init__(self, interval: float):
+        super().__init__(name='sampler', daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident or _is_idle(frame):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} '
+                                 f'({Path(code.co_filename).name}:'
+                                 f'{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def write(self, name: str) -> Path:
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        path = profile_dir / f'{name}-{timestamp}.folded'
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.items():
+                f.write(f'{stack} {count}\n')
+        return path
+
+
+def profiled(name: str, slow_threshold: float):
+    """Time every call of a coroutine function and sample the armed ones"""
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            sampler = None
+            if armed_runs.get(name):
+                armed_runs[name] -= 1
+                sampler = Sampler(config.PROFILE_SAMPLE_INTERVAL)
+                sampler.start()
+            started_at = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started_at
+                if sampler is not None:
+                    sampler.stop()
+                    path = sampler.write(name)
+                    logging.info(f'Profile of {name} written to {path}')
+                if elapsed > slow_threshold:
+                    _setup_slow_logger()
+                    slow_logger.warning(f'{name} took {elapsed:.2f}s')
+
+        return wrapper
+
+    return decorator
+
+
+for _name in config.PROFILE_NAMES:
+    arm(_name, config.PROFILE_RUNS)
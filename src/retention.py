@@ -0,0 +1,156 @@
+"""Retention and compaction of the stored data
+
+    python src/retention.py
+
+Reviews older than REVIEWS_RETENTION_DAYS are archived (or expired by
+mongo in the expire mode), photo urls of old reviews are dropped in favor
+of their ids, embedded copies are reduced to references and the daily
+buckets of the branch stats are pruned past the longest stats window.
+"""
+import datetime
+import logging
+
+from pymongo import UpdateOne
+
+import config
+import db
+from utils import STATS_WINDOWS
+
+users_db = db.get_users_collection()
+branches_db = db.get_branches_collection()
+reviews_db = db.get_reviews_collection()
+archive_db = db.get_reviews_archive_collection()
+stats_db = db.get_branch_stats_collection()
+
+
+def _days_ago(days: int) -> datetime.datetime:
+    return datetime.datetime.now(
+        datetime.timezone.utc) - datetime.timedelta(days=days)
+
+
+def compact_users() -> int:
+    """Replace the branches embedded in users by their ids"""
+    result = users_db.update_many(
+        {'branches': {
+            '$elemMatch': {
+                'name': {
+                    '$exists': True
+                }
+            }
+        }}, [{
+            '$set': {
+                'branches': {
+                    '$map': {
+                        'input': '$branches',
+                        'in': {
+                            'id': '$$this.id'
+                        }
+                    }
+                }
+            }
+        }])
+    return result.modified_count
+
+
+def compact_branches() -> int:
+    """Reduce the companies embedded in branches to references"""
+    result = branches_db.update_many(
+        {
+            'company': {
+                '$type': 'object'
+            },
+            '$expr': {
+                '$gt': [{
+                    '$size': {
+                        '$objectToArray': '$company'
+                    }
+                }, 2]
+            }
+        }, [{
+            '$set': {
+                'company': {
+                    '_id': '$company._id',
+                    'name': '$company.name'
+                }
+            }
+        }])
+    return result.modified_count
+
+
+def archive_reviews() -> int:
+    """Move the reviews past the retention to the archive, batch by batch
+    so a review is only deleted once archived"""
+    if (not config.REVIEWS_RETENTION_DAYS
+            or config.REVIEWS_RETENTION_MODE != 'archive'):
+        return 0
+    old = {
+        'created_at': {
+            '$lt': _days_ago(config.REVIEWS_RETENTION_DAYS)
+        }
+    }
+    archived = 0
+    while True:
+        reviews = list(
+            reviews_db.find(old, {
+                '_id': 0
+            }).limit(config.RETENTION_BATCH_SIZE))
+        if not reviews:
+            return archived
+        archive_db.bulk_write([
+            UpdateOne({'id': review['id']}, {'$setOnInsert': review},
+                      upsert=True) for review in reviews
+        ],
+                              ordered=False)
+        archived += reviews_db.delete_many({
+            'id': {
+                '$in': [review['id'] for review in reviews]
+            }
+        }).deleted_count
+
+
+def compact_photos() -> int:
+    """Drop the photo urls of old reviews which photo ids are known"""
+    result = reviews_db.update_many(
+        {
+            'created_at': {
+                '$lt': _days_ago(config.PHOTOS_RETENTION_DAYS)
+            },
+            'photos.0': {
+                '$exists': True
+            },
+            'photo_ids.0': {
+                '$exists': True
+            }
+        }, {'$unset': {
+            'photos': ''
+        }})
+    return result.modified_count
+
+
+def prune_stats_days() -> int:
+    """Drop the daily stats buckets no stats window reaches anymore"""
+    since = (datetime.date.today() -
+             datetime.timedelta(days=max(STATS_WINDOWS) + 1)).isoformat()
+    operations = []
+    for stats in stats_db.find({}, {'days': 1}):
+        old_days = [day for day in stats.get('days', {}) if day < since]
+        if old_days:
+            operations.append(
+                UpdateOne({'_id': stats['_id']},
+                          {'$unset': {f'days.{day}': ''
+                                      for day in old_days}}))
+    if operations:
+        stats_db.bulk_write(operations, ordered=False)
+    return len(operations)
+
+
+def apply_retention():
+    for step in (compact_users, compact_branches, archive_reviews,
+                 compact_photos, prune_stats_days):
+        logging.info(f'{step.__name__}: {step()}')
+
+
+if __name__ == '__main__':
+    format = "%(levelname)s:%(asctime)s:%(message)s"
+    logging.basicConfig(format=format, level=logging.INFO, datefmt="%H:%M:%S")
+    apply_retention()
@@ -1,217 +1,131 @@
+"""Plain http scraping
+
+The browser based scrapers live in the browser module, they are only
+imported when first used through this module as pyppeteer is heavy.
+"""
 import asyncio
 import concurrent.futures
+import importlib
 import logging
-from typing import Optional
+import threading
+import time
+from typing import Iterator, Optional
 
-from pyppeteer.browser import Browser
-from pyppeteer.element_handle import ElementHandle
-from pyppeteer.errors import ElementHandleError
-from pyppeteer.page import Page
-from requests_html import HTML, HTMLSession
+import lxml.html
+import requests
 
 import config
-from utils import (clean_text, get_new_page, get_reviews_api_key,
-                   safe_close_page, save_cookies)
-
-
-async def _close_cookies_footer_if_needed(page: Page,
-                                          close_selector: str or None = None):
-    if close_selector is None:
-        close_selector = '._euwdl0'
-    close_btn = await page.querySelector(close_selector)
-    if close_btn is not None:
-        await close_btn.click()
+from models import ApiReview, Review, reviews_page_decoder
+from utils import clean_text
 
+# Names resolved from the browser module on first access
+_BROWSER_ENTRY_POINTS = ('extract_branches_data_from_divs', 'get_review_data',
+                         'get_branches_data', 'scrape_branch_reviews')
 
-async def extract_branches_data_from_divs(
-        page: Page, divs: list[ElementHandle]) -> list[dict]:
-    """Extract branches links from divs"""
-
-    data = []
-    if not divs:
-        return data
-    org_name = None
-    for div in divs:
-        html = await page.evaluate('(element) => element.outerHTML', div)
-        html_object = HTML(html=clean_text(html))
-        if org_name is None:
-            org_name = html_object.find('div span._1al0wlf span',
-                                        first=True).text
-            additional = html_object.find('span._oqoid', first=True).text
-            if additional:
-                org_name = f'{org_name}, {additional}'.capitalize()
-        link = html_object.find('div._zjunba a',
-                                first=True).attrs.get('href').split('?')[0]
-        name = html_object.find('div._klarpw span._1w9o2igt',
-                                first=True).text.strip()
-        data.append({
-            'id': link.split('/')[-1],
-            'name': clean_text(name),
-            'link': link,
-            'org_name': org_name
-        })
-    return data
-
-
-async def _navigate_to_next_page(page: Page) -> bool:
-    """Navigate to the next page of the reviews"""
-    try:
-        active_btn_class = '_n5hmn94'
-        secont_btn_div = await page.querySelector('._5ocwns > *:nth-child(2)')
-        div_class = await page.evaluate("(node) => node.getAttribute('class')",
-                                        secont_btn_div)
-        if div_class == active_btn_class:
-            await secont_btn_div.click()
-            await page.waitForNavigation()
-            await page.waitForSelector('._5ocwns')
-            return True
-    except ElementHandleError:
-        # Navigation buttons don't exist
-        pass
-
-    return False
-
-
-async def _load_reviews(page: Page):
-    """Load all reviews into the html page"""
-    load_btn_class = '_1iczexgz'
-    load_btn = await page.querySelector(f'.{load_btn_class}')
-    try:
-        logging.info("Loading reviews into page")
-        while load_btn is not None:
-            await load_btn.click()
-            await asyncio.sleep(0.2)
-            load_btn = await page.querySelector(f'.{load_btn_class}')
-        logging.info('reviews loaded')
-    except ElementHandleError:
-        logging.warn('Loading failed, skipping...')
-
-
-async def get_review_data(page: Page, review: ElementHandle) -> dict:
-    """Get all data from a review"""
-    html = await page.evaluate('(element) => element.outerHTML', review)
-    html_object = HTML(html=clean_text(html))
-    # Scrape the commenter's name
-    name = html_object.find('div._1wz5xvq span._16s5yj36', first=True).text
-
-    # Scrape the date of the comment
-    date = html_object.find('div._4mwq3d', first=True).text
-
-    # Scrape the photos uploaded (if any)
-    photos = [img.attrs['src'] for img in html_object.find('img._1env6hv')]
-
-    # Scrape the comment
-    text = None
-    try:
-        text = html_object.find('div._49x36f a._ayej9u3', first=True).text
-    except AttributeError:
-        text = html_object.find('a._1it5ivp', first=True).text
-
-    # Scrape the reply (if any)
-    reply_element = html_object.find('div._sgs1pz', first=True)
-    reply = {}
-    if reply_element:
-        reply_name = reply_element.find('div._y7bbr0 span', first=True).text
-        reply_date = reply_element.find('div._1fw4r5p',
-                                        first=True).text.split(',')[0]
-        reply_text = reply_element.find('div._j1il10', first=True).text
-        reply = {
-            'org_name': clean_text(reply_name),
-            'date': reply_date,
-            'text': clean_text(reply_text)
-        }
 
-    return {
-        'name': name,
-        'date': date,
-        'photos': photos,
-        'text': clean_text(text),
-        'reply': reply
-    }
+def __getattr__(name: str):
+    if name in _BROWSER_ENTRY_POINTS:
+        return getattr(importlib.import_module('browser'), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
-async def get_branches_data(
-        page: Page,
-        city: Optional[str] = 'ufa',
-        company_name: Optional[str] = 'Вкусно — и точка') -> list[dict]:
-    """Get all branches links from 2gis.ru"""
+class RateLimiter:
+    """Space out requests made from any thread to `rate` per second"""
 
-    branches_data = []
-    await page.goto(f'https://2gis.ru/{city}/search/{company_name}')
-    await page.waitForSelector('._1kf6gff')
-    await _close_cookies_footer_if_needed(page)
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next_at = 0.0
+        self._lock = threading.Lock()
 
-    logging.info('Extracting branches data')
-    divs = await page.querySelectorAll('._1kf6gff')
-    branches_data.extend(await extract_branches_data_from_divs(page, divs))
-    while await _navigate_to_next_page(page):
-        divs = await page.querySelectorAll('._1kf6gff')
-        branches_data.extend(await extract_branches_data_from_divs(page, divs))
-    logging.info(f"Extracted {len(branches_data)} branches' data")
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_at - now
+            self._next_at = max(now, self._next_at) + self.interval
+        if delay > 0:
+            time.sleep(delay)
 
-    await save_cookies(page)
-    await safe_close_page(page)
-    return branches_data
 
+# Budget of the live reviews api calls
+api_limiter = RateLimiter(config.API_RATE)
+# Budget of the 2gis search pages requests, shared by all cities
+search_limiter = RateLimiter(config.SEARCH_RATE)
+# Threads of every city search, they mostly wait on the limiter and must not
+# hold the threads of the bot's event loop
+search_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=config.SEARCH_WORKERS, thread_name_prefix='search')
 
-def safe_scrape(scraper_function,
-                semaphore: asyncio.Semaphore = asyncio.Semaphore(3)):
 
-    async def runner(*args, **kwargs):
-        async with semaphore:
-            await scraper_function(*args, **kwargs)
+# requests_html's default, the one search pages were first scraped with
+USER_AGENT = ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) '
+              'AppleWebKit/603.3.8 (KHTML, like Gecko) Version/10.1.2 '
+              'Safari/603.3.8')
 
-    return runner
 
+def _find(element, selector: str):
+    """First element matching a css selector, None if there is none"""
+    found = element.cssselect(selector)
+    return found[0] if found else None
 
-@safe_scrape
-async def scrape_branch_reviews(branch_data: dict,
-                                page: Page or None = None,
-                                browser: Browser or None = None,
-                                ensure_reviews_loaded: Optional[bool] = True):
-    """Scrape reviews from a branch"""
-    if page is None and browser is None:
-        raise RuntimeError('At least one of page or browser must be provided')
-    if page is None:
-        page = await get_new_page(browser)
 
-    try:
-        await page.goto(f"https://2gis.ru{branch_data['link']}/tab/reviews",
-                        {'waitUntil': "domcontentloaded"})
+def _text(element) -> str:
+    # Whitespace squashed like pyquery does
+    return ' '.join(element.text_content().split())
 
-        logging.info(f"Extracting reviews from {branch_data['name']}")
 
-        if ensure_reviews_loaded:
-            await _load_reviews(page)
+def parse_org_name(div) -> str:
+    """Company name from a search result div"""
+    org_name = _text(_find(div, 'div span._1al0wlf span'))
+    additional = _find(div, 'span._oqoid')
+    if additional is not None and _text(additional):
+        org_name = f'{org_name}, {_text(additional)}'.capitalize()
+    return org_name
 
-        divs = await page.querySelectorAll('._11gvyqv')
-        reviews = []
-        for div in divs:
-            review = await get_review_data(page, div)
-            reviews.append(review)
 
-        logging.info(
-            f"extracted {len(reviews)} reviews from {branch_data['name']}")
+def parse_branch_div(div, org_name: str, city: str or None = None) -> dict:
+    """Branch of a search result div"""
+    name = _text(_find(div, 'div._klarpw span._1w9o2igt')).strip()
+    link = _find(div, 'div._zjunba a').get('href').split('?')[0]
+    return {
+        'id': link.split('/')[-1],
+        'name': clean_text(name),
+        'link': link,
+        'city': city,
+        'org_name': org_name
+    }
 
-        await save_cookies(page)
 
-    finally:
-        await page.close()
-        return reviews
+def parse_branches_page(html,
+                        city: str or None = None,
+                        org_name: str or None = None) -> list[dict]:
+    """Branches of a search results page parsed by lxml, the company name
+    is read from the first result unless given"""
+    branches = []
+    for div in html.cssselect('div._1kf6gff'):
+        if org_name is None:
+            org_name = parse_org_name(div)
+        branches.append(parse_branch_div(div, org_name, city))
+    return branches
 
 
 def get_branches(company_name: Optional[str] = "ташир пицца",
                  city: Optional[str] = 'ufa') -> list[dict]:
-
     url = f"https://2gis.ru/{city}/search/{company_name}"
-    session = HTMLSession()
+    session = requests.Session()
+    session.headers['User-Agent'] = USER_AGENT
 
     # Force the first request to succeed
-    # TODO Set a retry limit
+    search_limiter.wait()
     res = session.get(url)
     if res.status_code == 404:
         return []
+    retries = 0
     while res.status_code != 200:
+        if retries == config.SEARCH_RETRIES:
+            logging.warning(f'Search of {company_name} in {city} failed')
+            return []
+        retries += 1
+        search_limiter.wait()
         res = session.get(url)
 
     first_response_url = res.url
@@ -220,33 +134,22 @@ def get_branches(company_name: Optional[str] = "ташир пицца",
     counter = 1
     org_name = None
     try:
+        page = lxml.html.fromstring(res.content)
         while True:
             url = f"https://2gis.ru/{city}/search/{company_name}"
-            divs = res.html.find('div._1kf6gff')
-            for div in divs:
-                if org_name is None:
-                    org_name = div.find('div span._1al0wlf span',
-                                        first=True).text
-                    additional = div.find('span._oqoid', first=True).text
-                    if additional:
-                        org_name = f'{org_name}, {additional}'.capitalize()
-                name = div.find('div._klarpw span._1w9o2igt', first=True).text
-                link = div.find('div._zjunba a',
-                                first=True).attrs.get('href').split('?')[0]
-                branch = {
-                    'id': link.split('/')[-1],
-                    'name': clean_text(name),
-                    'link': link,
-                    'org_name': org_name
-                }
-                branches.append(branch)
+            page_branches = parse_branches_page(page, city, org_name)
+            if page_branches:
+                org_name = page_branches[0]['org_name']
+            branches.extend(page_branches)
 
             # TODO: Deal with url returning down to first page
             counter += 1
+            search_limiter.wait()
             res = session.get(f"{url}/page/{counter}")
-            is_empty_page = res.html.find(
-                'div._1wpb8t2',
-                first=True) is not None or res.url == first_response_url
+            page = lxml.html.fromstring(res.content)
+            is_empty_page = _find(
+                page, 'div._1wpb8t2'
+            ) is not None or res.url == first_response_url
             if is_empty_page:
                 break
     except Exception as e:
@@ -255,61 +158,128 @@ def get_branches(company_name: Optional[str] = "ташир пицца",
     return branches
 
 
-def clean_api_reviews(reviews: list) -> list:
-
-    cleaned = [{
-        'id':
-        review['id'],
-        'name':
-        review['user']['name'],
-        'rating':
-        review['rating'],
-        'text':
-        review['text'],
-        'date':
-        review['date_created'],
-        'photos': [photo['preview_urls']['url'] for photo in review['photos']],
-        'reply':
-        review['official_answer']
-    } for review in reviews]
+def merge_branches(branches: list[dict]) -> list[dict]:
+    """Drop the duplicated branches, keeping the company found the most"""
+    if not branches:
+        return []
+    org_names = [branch['org_name'] for branch in branches]
+    org_name = max(set(org_names), key=org_names.count)
+    merged = {}
+    for branch in branches:
+        if branch['org_name'] == org_name:
+            merged.setdefault(branch['id'], branch)
+    return list(merged.values())
+
+
+def _get_city_branches(company_name: str, city: str) -> list[dict]:
+    """Branches of a company in a city, none if the search failed so the
+    other cities are still merged"""
+    try:
+        return get_branches(company_name, city)
+    except Exception as e:
+        logging.error(f'Search of {company_name} in {city} failed: {e}')
+        return []
+
+
+async def stream_branches(company_name: str, cities: list[str]):
+    """Search a company in every city, yield each city with its branches as
+    soon as its search is done"""
+
+    async def search(city: str) -> tuple[str, list[dict]]:
+        return city, await asyncio.get_running_loop().run_in_executor(
+            search_executor, _get_city_branches, company_name, city)
+
+    for task in asyncio.as_completed([search(city) for city in cities]):
+        yield await task
+
+
+def get_branches_in_cities(company_name: str,
+                           cities: list[str]) -> list[dict]:
+    """Search a company in every city, in parallel"""
+    branches = []
+    results = [
+        search_executor.submit(_get_city_branches, company_name, city)
+        for city in cities
+    ]
+    for f in concurrent.futures.as_completed(results):
+        branches.extend(f.result())
+
+    return merge_branches(branches)
+
+
+def clean_api_reviews(reviews: list[ApiReview],
+                      branch_id: str) -> list[Review]:
+
+    cleaned = [
+        Review(id=review.id,
+               branch_id=branch_id,
+               name=review.user.name,
+               rating=review.rating,
+               text=review.text or '',
+               date=review.date_created,
+               photos=[photo.preview_urls.url for photo in review.photos],
+               photo_ids=[photo.id for photo in review.photos if photo.id],
+               reply=review.official_answer) for review in reviews
+    ]
 
     return cleaned
 
 
+def iter_branch_review_pages(
+        branch_id: str,
+        key: str,
+        next_link: str or None = None,
+        limit: int = 50,
+        limiter: RateLimiter or None = None
+) -> Iterator[tuple[list[Review], str or None]]:
+    """Yield each page of branch reviews along with the link to the next
+    one, starting from next_link when given"""
+    if limiter is None:
+        limiter = api_limiter
+    url = next_link
+    params = None
+    if url is None:
+        url = f"{config.REVIEW_API_URL}/{branch_id}/reviews"
+        params = {'key': key, 'limit': limit, 'sort_by': 'date_created'}
+    session = requests.Session()
+
+    while url:
+        limiter.wait()
+        res = session.get(url, params=params)
+        if res.status_code == 404:
+            logging.warning(f'Reviews api has no branch {branch_id}')
+            return
+        if not res.status_code == 200:
+            logging.warning(f'Reviews api answered {res.status_code} '
+                            f'for {branch_id}')
+            # Callers must not take a failed page for an empty one
+            res.raise_for_status()
+        data = reviews_page_decoder.decode(res.content)
+        url, params = data.meta.next_link, None
+        yield clean_api_reviews(data.reviews, branch_id), url
+
+
 def get_branch_reviews(branch_id: str,
                        key: str,
                        branch_name: str or None = None,
                        limit: int = 50,
-                       get_all: bool = False) -> list:
+                       get_all: bool = False) -> list[Review]:
     """Get branch reviews through public api"""
     if branch_name is not None:
         logging.info(f'Getting reviews for {branch_name}')
-    endpoint = f"{config.REVIEW_API_URL}/{branch_id}/reviews"
-    params = {'key': key, 'limit': limit, 'sort_by': 'date_created'}
-    session = HTMLSession()
-    res = session.get(endpoint, params=params)
     reviews = []
-    data = None
-    next_link = None
-
-    while True:
-        if not res.status_code == 200:
-            break
-        data = res.json()
-        reviews.extend(data['reviews'])
+    for page_reviews, _ in iter_branch_review_pages(branch_id, key,
+                                                    limit=limit):
+        reviews.extend(page_reviews)
         if not get_all:
             break
-        next_link = data['meta'].get('next_link')
-        if not next_link:
-            break
-        res = session.get(next_link)
 
     if branch_name is not None:
         logging.info(f'Got reviews for {branch_name}')
-    return clean_api_reviews(reviews)
+    return reviews
 
 
-def get_reviews_through_api(key: str, branches_data: list) -> list:
+def get_reviews_through_api(key: str, branches_data: list) -> list[Review]:
     """Get reviews through public api"""
     end_data = []
     with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
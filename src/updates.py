@@ -0,0 +1,49 @@
+import asyncio
+import sys
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Process updates of different chats concurrently.
+
+    Updates of the same chat are still handled one by one, in arrival order,
+    as the conversation handlers rely on it.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        # The base class semaphore is taken before do_process_update, where
+        # queued updates of a busy chat would hold it while waiting on their
+        # chat. It is left unbounded and the limit is applied after the lock.
+        super().__init__(sys.maxsize)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._pending: dict[int, int] = {}
+
+    async def do_process_update(self, update: object,
+                                coroutine: Awaitable[Any]) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        lock = self._locks.setdefault(chat.id, asyncio.Lock())
+        self._pending[chat.id] = self._pending.get(chat.id, 0) + 1
+        try:
+            async with lock, self._slots:
+                await coroutine
+        finally:
+            self._pending[chat.id] -= 1
+            if not self._pending[chat.id]:
+                # Nobody waits on this chat anymore
+                del self._pending[chat.id]
+                del self._locks[chat.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -1,23 +1,18 @@
 import asyncio
 import datetime
-import json
+import html
 import pickle
 import unicodedata
-from pathlib import Path
-from urllib.parse import parse_qs, urlparse
+from typing import Callable, Optional
 
 import emoji
 from dateutil.parser import isoparse
-from fake_useragent import UserAgent
-from pyppeteer.browser import Browser
-from pyppeteer.launcher import launch
-from pyppeteer.network_manager import Request
-from pyppeteer.page import Page
-from telegram import InputMediaPhoto, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import (InlineKeyboardButton, InlineKeyboardMarkup,
+                      InputMediaPhoto, LinkPreviewOptions)
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes
 
-import config
+from models import Review
 
 ####
 ## Scraping utils
@@ -32,68 +27,6 @@ def clean_text(raw_text: str) -> str:
     return cleaned_text
 
 
-def get_user_agent():
-    ua = UserAgent(verify_ssl=False)
-    return ua.random
-
-
-async def load_cookies(page: Page):
-    if Path('cookies.json').exists():
-        with open('cookies.json', 'r') as f:
-            cookies = json.load(f)
-            await page.setCookie(*cookies)
-
-
-async def save_cookies(page: Page):
-    cookies = await page.cookies()
-    with open('cookies.json', 'w') as f:
-        json.dump(cookies, f)
-
-
-async def get_new_page(browser: Browser or None = None,
-                       page: Page or None = None) -> Page:
-    if browser is None and page is None:
-        raise RuntimeError('browser or page must be provided')
-    if browser:
-        page = await browser.newPage()
-    page.setDefaultNavigationTimeout(0)
-    await load_cookies(page)
-    return page
-
-
-async def safe_close_page(page):
-    pages = await page.browser.pages()
-    if len(pages) > 1:
-        await page.close()
-        return True
-    return False
-
-
-async def get_reviews_api_key(
-        reviews_url:
-    str = "https://2gis.ru/ufa/branches/2393075273031352/firm/70000001007027017/tab/reviews",
-        page: Page or None = None) -> str:
-    if page is None:
-        raise RuntimeError('page must be provided')
-    intercepted_request = None
-    page.on('request', lambda req: asyncio.ensure_future(intercept(req)))
-
-    async def intercept(request: Request):
-        nonlocal intercepted_request
-        if request.url.startswith(config.REVIEW_API_URL):
-            intercepted_request = request
-
-    # Navigate to the page where the request will be made
-    await page.goto(reviews_url)
-    await page.waitForRequest(lambda _: intercepted_request is not None)
-
-    parsed_url = urlparse(intercepted_request.url)
-    query_params = parse_qs(parsed_url.query)
-    # the key or an empty string
-    key = query_params.get('key', [''])[0]
-    return key
-
-
 ####
 ## Telegram utils
 ####
@@ -120,18 +53,39 @@ def set_cached_datetime(new_datetime: datetime.datetime):
         pickle.dump(new_datetime.astimezone(), file)
 
 
-async def _send_review(context: ContextTypes.DEFAULT_TYPE, user_ids: list,
-                       review: dict):
-    photos_urls = review['photos']
-    rating_str = emoji.emojize(':star:' * review['rating'] + ':new_moon:' *
-                               (5 - review['rating']))
+# Telegram limits
+MESSAGE_LIMIT = 4096
+# Bytes of a file sent by a bot
+UPLOAD_LIMIT = 50 * 1024 * 1024
+# Longer review texts are cut in digests so one review fits in a message
+DIGEST_TEXT_LIMIT = 3000
+
+
+def _format_review(review: Review, text_limit: int or None = None) -> str:
+    rating_str = emoji.emojize(':star:' * review.rating + ':new_moon:' *
+                               (5 - review.rating))
 
     # TODO: Better way to handle timezones
     # As for now, just adapting to ufa timezone
-    date_str = (isoparse(review['date']) -
+    date_str = (isoparse(review.date) -
                 datetime.timedelta(hours=2)).strftime('%d %B %Y %H:%M')
 
-    text = f'<b>{rating_str} {review["name"]}</b>\n<i>{date_str}</i>\n\n{review["text"]}\n\n'
+    review_text = review.text
+    if text_limit is not None and len(review_text) > text_limit:
+        review_text = f'{review_text[:text_limit]}…'
+    return (f'<b>{rating_str} {html.escape(review.name)}</b>\n'
+            f'<i>{date_str}</i>\n\n{html.escape(review_text)}\n\n')
+
+
+def _format_branch_header(branch_name: str, company_name: str) -> str:
+    return emoji.emojize(f'<b>{html.escape(company_name)}</b>\n\n'
+                         f'📍 {html.escape(branch_name)} 📍')
+
+
+async def _send_review(context: ContextTypes.DEFAULT_TYPE, user_ids: list,
+                       review: Review):
+    photos_urls = review.photos
+    text = _format_review(review)
     for user_id in user_ids:
         if photos_urls:
             media = [InputMediaPhoto(url) for url in photos_urls]
@@ -147,7 +101,7 @@ async def _send_review(context: ContextTypes.DEFAULT_TYPE, user_ids: list,
 
 async def _notify_branch(context: ContextTypes.DEFAULT_TYPE, user_ids: list,
                          branch_name: str, company_name: str):
-    text = emoji.emojize(f'<b>{company_name}</b>\n\n📍 {branch_name} 📍')
+    text = _format_branch_header(branch_name, company_name)
     for user_id in user_ids:
         await context.bot.send_message(chat_id=user_id,
                                        text=text,
@@ -155,7 +109,8 @@ async def _notify_branch(context: ContextTypes.DEFAULT_TYPE, user_ids: list,
 
 
 async def send_reviews(context: ContextTypes.DEFAULT_TYPE, user_ids: list,
-                       reviews: list, branch_name: str, company_name: str):
+                       reviews: list[Review], branch_name: str,
+                       company_name: str):
     await _notify_branch(context, user_ids, branch_name, company_name)
     sending_tasks = [
         _send_review(context, user_ids, review) for review in reviews
@@ -163,9 +118,104 @@ async def send_reviews(context: ContextTypes.DEFAULT_TYPE, user_ids: list,
     await asyncio.gather(*sending_tasks)
 
 
-def build_branches_markup(
-        branches: list,
-        with_company_name: bool = False) -> InlineKeyboardMarkup:
+async def deliver_reviews(context: ContextTypes.DEFAULT_TYPE, user_id: int,
+                          reviews: list[Review], branch_name: str,
+                          company_name: str, on_sent: Callable[[Review],
+                                                               None]):
+    """Send reviews to a user one after the other, on_sent is called once
+    each of them is sent"""
+    await _notify_branch(context, [user_id], branch_name, company_name)
+    for review in reviews:
+        await _send_review(context, [user_id], review)
+        on_sent(review)
+
+
+def _pack_digest(sections: list) -> list[tuple[str, list[Review]]]:
+    chunks = []
+    for branch_name, company_name, reviews in sections:
+        chunks.append(
+            (f'{_format_branch_header(branch_name, company_name)}\n\n', None))
+        for review in reviews:
+            text = _format_review(review, text_limit=DIGEST_TEXT_LIMIT)
+            photos_links = ' '.join(
+                f'<a href="{html.escape(url)}">📷{i}</a>'
+                for i, url in enumerate(review.photos, start=1))
+            if photos_links:
+                text = f'{text}{photos_links}\n\n'
+            chunks.append((text, review))
+
+    messages = []
+    current, current_reviews = '', []
+    for chunk, review in chunks:
+        if current and len(current) + len(chunk) > MESSAGE_LIMIT:
+            messages.append((current, current_reviews))
+            current, current_reviews = '', []
+        current += chunk
+        if review is not None:
+            current_reviews.append(review)
+    if current:
+        messages.append((current, current_reviews))
+    return messages
+
+
+def build_digest_messages(sections: list) -> list[str]:
+    """Pack (branch_name, company_name, reviews) sections into as few
+    messages as the telegram length limit allows, photos become links"""
+    return [text for text, _ in _pack_digest(sections)]
+
+
+async def send_digest(context: ContextTypes.DEFAULT_TYPE,
+                      user_id: int,
+                      sections: list,
+                      on_sent: Optional[Callable[[list[Review]],
+                                                 None]] = None):
+    """Send all new reviews of a user's branches at once, on_sent is called
+    with the reviews of each message once it is sent"""
+    for text, reviews in _pack_digest(sections):
+        await context.bot.send_message(
+            chat_id=user_id,
+            text=text,
+            parse_mode=ParseMode.HTML,
+            link_preview_options=LinkPreviewOptions(is_disabled=True))
+        if on_sent is not None:
+            on_sent(reviews)
+
+
+# Days the average rating is given for
+STATS_WINDOWS = (7, 30, 90, 365)
+
+
+def format_branch_stats(stats: dict, branch_name: str,
+                        company_name: str) -> str:
+    """Rating distribution and averages of a branch stats document"""
+    text = f'{_format_branch_header(branch_name, company_name)}\n\n'
+    count = stats['count']
+    text += (f'<b>Отзывов</b>: {count}, <b>средняя оценка</b>: '
+             f'{stats["rating_sum"] / count:.2f}\n\n')
+    for rating in range(5, 0, -1):
+        rating_count = stats['ratings'].get(str(rating), 0)
+        text += emoji.emojize(f'{rating}:star: {rating_count} '
+                              f'({rating_count / count:.0%})\n')
+    text += '\n'
+
+    today = datetime.date.today()
+    for window in STATS_WINDOWS:
+        since = (today - datetime.timedelta(days=window)).isoformat()
+        days = [bucket for day, bucket in stats['days'].items() if day > since]
+        window_count = sum(bucket['count'] for bucket in days)
+        if not window_count:
+            text += f'<i>За {window} дн.</i>: нет отзывов\n'
+            continue
+        window_average = sum(bucket['rating_sum']
+                             for bucket in days) / window_count
+        text += (f'<i>За {window} дн.</i>: {window_average:.2f} '
+                 f'({window_count})\n')
+    return text
+
+
+def build_branches_markup(branches: list,
+                          with_company_name: bool = False,
+                          callback_prefix: str = '') -> InlineKeyboardMarkup:
     colums = []
     for branch in branches:
         text = branch['name']
@@ -173,5 +223,6 @@ def build_branches_markup(
             company_name = branch['company']['name'].split(',')[0]
             text = f"{company_name} - {text}"
         colums.append(
-            InlineKeyboardButton(text=text, callback_data=branch['id']))
+            InlineKeyboardButton(text=text,
+                                 callback_data=f"{callback_prefix}{branch['id']}"))
     return InlineKeyboardMarkup.from_column(colums)
\ No newline at end of file